@@ -1,9 +1,38 @@
 import streamlit as st
-import random
+import logging
 import time
-from zhipuai import ZhipuAI
+from functools import partial
+
+import config
+import context
+import generation_worker
+import image_pipeline
+import knowledge_base
+import llm_client
+import llm_provider
+import llm_router
+import metrics
+import report_engine
+import response_cache
+import session_store
+import smart_reply
+import vision
+from stage_detector import EVENT_QUESTION, EVENT_REPORT
+from prompts import (
+    CACHEABLE_PROMPTS, CMD_GENERATE_REPORT, FOLLOW_UP_PROMPTS, INTERRUPTED_NOTE, MAX_TURNS,
+    OFFLINE_FOLLOW_UP, OFFLINE_QUESTION_NOTE, OFFLINE_QUESTIONS, STARTER_PROMPTS,
+)
+from stream_render import StreamRenderer, split_sections
+from tip_pool import TipPool
 
 # ================= 0. 基础配置 =================
+# 本次页面运行的起始时间，用于统计重跑耗时
+_run_started = time.perf_counter()
+# 整页运行是否已结束：片段单独重跑时沿用上次整页运行的模块变量，此时为 True
+_run_finished = False
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+logger = logging.getLogger("zhongyi.app")
+
 # 尝试获取API KEY，如果没配置secrets则提示
 try:
     api_key = st.secrets["API_KEY"]
@@ -12,18 +41,15 @@ except:
     api_key = "你的_API_KEY_在这里" 
     # st.warning("未检测到 .streamlit/secrets.toml 配置，请确保API KEY正确。")
 
-# 核心修改：如果没有有效的 Key，直接停止运行并提示用户
-if not api_key or "YOUR_API_KEY" in api_key:
+# 核心修改：如果没有有效的 Key，直接停止运行并提示用户（本地桩模式无需 Key）
+if config.LLM_PROVIDER != "stub" and (not api_key or "YOUR_API_KEY" in api_key):
     st.error("⚠️ 未检测到有效的 API Key！")
     st.info("请在 .streamlit/secrets.toml 中配置 API_KEY，或在 Streamlit Cloud 后台设置 Secrets。")
     st.stop()
 
-client = ZhipuAI(api_key=api_key)
-
-# 最大轮次改为 8
-MAX_TURNS = 8
-
-CMD_GENERATE_REPORT = "我描述完了。请按照规定的Markdown格式，引用古籍，给出详细的、篇幅较长的诊断报告（包含具体的食疗方做法和穴位位置）。"
+# 大模型后端及连接池全进程共用，不随每次页面重跑重新创建；外层按任务路由模型并负责超时、重试与熔断
+provider = llm_router.get_provider(api_key)
+metrics.start_http_server()
 
 st.set_page_config(page_title="中医智能小助手", page_icon="🌿", layout="wide")
 
@@ -143,95 +169,84 @@ FALLBACK_TIPS = [
 
 # ================= 2. 逻辑函数与状态 =================
 
-# 调用AI生成随机养生知识的函数
-def get_ai_health_tip():
-    """让AI随机生成一条养生建议"""
-    try:
-        themes = ["饮食", "睡眠", "运动", "情志", "四季", "穴位", "饮茶"]
-        theme = random.choice(themes)
-        prompt = f"""
-        请生成一条关于中医“{theme}”的养生小知识，要求：
-        1.  严格遵循中医理论，不包含任何西医术语，贴合《黄帝内经》等经典中医著作的核心思想。
-        2.  内容简短（30字以内），通俗易懂，语气亲切，必须包含1个贴合主题的emoji。
-        3.  内容具体可落地，避免空泛表述（如“不要熬夜”改为“23点前入睡，养肝血护正气”）。
-        4.  不要输出任何解释性内容，直接给出养生小知识本身。
-        5.  避免夸大疗效，不使用“根治”“百分百”等表述。
-        """
-        
-        response = client.chat.completions.create(
-            model="glm-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.9 
+TIP_THEMES = ["饮食", "睡眠", "运动", "情志", "四季", "穴位", "饮茶"]
+
+# 侧边栏照片功能：按钮文字 -> 照片类型
+IMAGE_BUTTONS = {
+    "👅 AI舌诊": vision.KIND_TONGUE,
+    "😐 AI面诊": vision.KIND_FACE,
+    "📄 拍报告": vision.KIND_LAB_REPORT,
+    "💊 拍药盒": vision.KIND_MEDICINE,
+}
+# 上传框提示
+IMAGE_HINTS = {
+    vision.KIND_TONGUE: "自然光下伸出舌头拍照，舌面平展放松",
+    vision.KIND_FACE: "自然光下正面拍照，不化妆、不开美颜",
+    vision.KIND_LAB_REPORT: "拍下报告中的检查结果部分，文字清晰即可",
+    vision.KIND_MEDICINE: "拍下药盒正面或说明书",
+}
+
+# 调用AI生成指定主题养生知识的函数（由锦囊池的后台线程调用）
+def generate_health_tip(theme):
+    """让AI生成一条指定主题的养生建议，失败时抛出异常"""
+    prompt = f"""
+    请生成一条关于中医“{theme}”的养生小知识，要求：
+    1.  严格遵循中医理论，不包含任何西医术语，贴合《黄帝内经》等经典中医著作的核心思想。
+    2.  内容简短（30字以内），通俗易懂，语气亲切，必须包含1个贴合主题的emoji。
+    3.  内容具体可落地，避免空泛表述（如“不要熬夜”改为“23点前入睡，养肝血护正气”）。
+    4.  不要输出任何解释性内容，直接给出养生小知识本身。
+    5.  避免夸大疗效，不使用“根治”“百分百”等表述。
+    """
+
+    model = llm_router.model_for(llm_provider.TASK_HEALTH_TIP)
+    with llm_client.limiter.slot("tip-pool"), metrics.track_call(llm_provider.TASK_HEALTH_TIP, model, "tip-pool") as record:
+        tip = provider.complete(
+            [{"role": "user", "content": prompt}],
+            task=llm_provider.TASK_HEALTH_TIP, model=model, temperature=0.9
         )
-        return response.choices[0].message.content
-    except Exception as e:
-        return random.choice(FALLBACK_TIPS)
+        record.prompt_tokens = context.count_tokens(prompt)
+        record.completion_tokens = context.count_tokens(tip)
+    return tip
+
+# 全进程共用一个锦囊池，所有会话共享，后台线程负责补货
+@st.cache_resource
+def get_tip_pool():
+    return TipPool(generate_health_tip, TIP_THEMES, FALLBACK_TIPS)
+
+def get_ai_health_tip():
+    """从锦囊池中取一条养生建议，池子为空时使用本地备用锦囊"""
+    return get_tip_pool().take(exclude=st.session_state.current_tip)
 
 def init_state():
-    if "messages" not in st.session_state:
-        # 允许 AI 自主决定何时结束问诊
-        system_prompt = f"""
-        你是一位经验丰富的中医主任医师，精通《黄帝内经》《伤寒杂病论》，擅长体质辨证。
-        
-        【阶段一：问诊】
-        1.  态度亲切，称呼“您”。
-        2.  **每次仅问1个核心问题**。
-        3.  你最多可以问 {MAX_TURNS} 个问题。
-        4.  **重要：智能收尾机制**
-            - 如果你在 {MAX_TURNS} 轮之前，已经收集到了足够的症状信息（寒热、汗液、二便、饮食、睡眠、情志、舌象等）足以精准辨证，**请直接停止提问，立即输出诊断报告**。
-            - 不需要等待用户说“描述完毕”，你可以主动给出结果。
-            - 如果信息不足，继续提问，直到第 {MAX_TURNS} 轮。
-        
-        【阶段二：诊断报告】
-        当决定生成报告时，**必须严格**遵循以下Markdown板块（不少于800字）：
-        
-        ### 🩺 深度辨证
-        1.  基于用户提供的所有症状，分析核心病机、阴阳虚实、脏腑盛衰，明确具体体质类型（如“阳虚质（脾肾阳虚）”“阴虚质（肝肾阴虚）”）。
-        2.  辨证过程需“症状→病机→体质”层层对应，逻辑清晰，让用户理解自身问题的根源。
-        
-        ### 📜 经典溯源
-        > 必须引用《黄帝内经》《伤寒杂病论》《金匮要略》中的1-2句经典原文（标注出处），原文需与用户的体质/症状高度相关。
-        *   **释义**：用通俗的现代语言解释古文含义，明确对应用户的具体症状，避免脱离用户实际情况的空泛解释。
-        
-        ### 🍵 膳食良方
-        1.  推荐2款适合用户体质的食疗方，严格遵循格式：【方名】+【食材】（标注具体克数，优先选择日常超市可采购的常见食材，避免名贵药材）+【做法】（3-4步内，步骤简洁可操作，无需专业厨具）+【功效】（贴合用户病机与体质，明确调理的脏腑/症状）+【适配提示】（明确优先食用人群、慎用人群（如孕妇、糖尿病患者）、食用频率（如“每日1次，连食7天”））。
-        2.  两款食疗方需品类不同（如一款粥品、一款汤品），满足用户不同场景的食用需求，避免重复。
-        
-        ### 🧘 导引按跷
-        1.  推荐2个与用户症状高度相关的关键穴位，严格遵循格式：【穴位名】（标注核心适配症状）+【位置】（详细文字描述+简易找法（如“握拳时，掌指关节后凹陷处”），确保新手可自行找到）+【手法】（明确按压/揉搓/按揉，标注每次操作时间（如“每次3分钟”）、频率（如“每日2次，早晚各1次”）、力度（如“以酸胀感为宜，避免暴力按压”）+【禁忌提示】（如“皮肤破损者禁用”“孕妇禁用”）。
-        2.  穴位选择优先选四肢、躯干的安全穴位，避免头部、面部的高风险穴位，确保用户自行操作的安全性。
-        
-        ### 🌞 起居禁忌
-        1.  作息建议：3条具体、可落地的作息方案，每条标注具体时间/频率+调理原理+贴合用户体质的原因（如“22:30前入睡（避免熬夜耗伤肝血，针对您的阴虚质，肝血不足会加重失眠症状）”）。
-        2.  忌口清单：明确3-5类具体忌口食物（如“生冷寒凉食物（冰饮、生菜）”）+ 忌口原因 + 适配替代食材（如“替代：可食用温性蔬菜（南瓜、胡萝卜）”），拒绝“辛辣刺激”这类笼统表述。
-        
-        ### 😊 情志调理
-        1.  推荐1-2条贴合用户症状/体质的简易情志调理建议，结合中医“情志致病”逻辑（如“怒伤肝、思伤脾、忧伤肺”）。
-        2.  内容简洁可操作，适配日常场景（如“每日静坐10分钟，深呼吸调理肺气，缓解焦虑情绪”），标注调理原理，避免空泛建议。
-        
-        ### ⚠️ 调理须知
-        1.  本报告仅为养生调理参考，不构成专业医疗诊断、治疗建议，不可替代中医师面诊及医嘱。
-        2.  若症状持续超过1周或加重（如剧烈疼痛、持续失眠），请及时前往正规医院中医科就诊。
-        3.  所有调理方案需坚持1-2周方可显现效果，因人而异，请勿急于求成。
-        
-        【补充强制要求】
-        1.  全程不使用任何西医术语（如“高血压”“胃炎”“维生素”），仅使用传统中医术语。
-        2.  语言风格专业、温和、严谨，避免夸大疗效（如不使用“根治”“百分百有效”等表述）。
-        3.  严格遵循板块格式，每个板块的子项清晰明了，方便用户阅读和操作。
-        4.  诊断报告中不得包含任何商业推广内容，仅提供纯养生调理建议。
-        """
-        st.session_state.messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "assistant", "content": "您好，我是您的中医智能小助手🌿。我可为您提供体质辨证、食疗方子、穴位按摩和情绪调理等养生帮助，您可以说说近日的身体状态，我来为您定制专属养生方案。"}
-        ]
-    
-    if "stage" not in st.session_state: st.session_state.stage = 0 
-    if "turn_count" not in st.session_state: st.session_state.turn_count = 0 
+    # 问诊状态保存在会话存储里，session_state 只记会话 ID；网址带 ?sid= 时续接原问诊
+    if "session_id" not in st.session_state:
+        store = session_store.get_store()
+        sid = st.query_params.get("sid")
+        consult = store.get(sid) if sid else None
+        if consult is None:
+            consult = store.create()
+        st.session_state.session_id = consult.session_id
+    if st.query_params.get("sid") != st.session_state.session_id:
+        st.query_params["sid"] = st.session_state.session_id
     if "current_tip" not in st.session_state: st.session_state.current_tip = FALLBACK_TIPS[0]
-    if "suggested_options" not in st.session_state: st.session_state.suggested_options = []
+    if "reply_future" not in st.session_state: st.session_state.reply_future = None
+    if "image_kind" not in st.session_state: st.session_state.image_kind = None
+    if "image_future" not in st.session_state: st.session_state.image_future = None
+    if "image_error" not in st.session_state: st.session_state.image_error = None
+    # 上传框的序号：照片提交后换一个新的上传框，清掉已提交的文件
+    if "image_upload_seq" not in st.session_state: st.session_state.image_upload_seq = 0
+
+def get_consultation():
+    """当前会话的问诊状态（闲置被换出后会从磁盘重建，因此每次都向存储取）"""
+    consult = session_store.get_store().get(st.session_state.session_id)
+    if consult is None:
+        # 会话记录丢失（如磁盘文件被清理）时重新开始
+        consult = session_store.get_store().create()
+        st.session_state.session_id = consult.session_id
+    return consult
 
 # === [修改点 3] 核心修复：优化生成回复选项的逻辑 ===
-def generate_smart_replies(last_ai_question):
+def generate_smart_replies(last_ai_question, session_id="smart-reply"):
     try:
         # 修改 prompt：专门处理“A还是B”的选择题
         prompt = f"""
@@ -248,12 +263,15 @@ def generate_smart_replies(last_ai_question):
         4. 直接输出3-4个答案，用竖线 "|" 分隔。
         """
         
-        response = client.chat.completions.create(
-            model="glm-4",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.5 
-        )
-        content = response.choices[0].message.content.strip()
+        model = llm_router.model_for(llm_provider.TASK_SMART_REPLY)
+        with llm_client.limiter.slot(session_id), metrics.track_call(llm_provider.TASK_SMART_REPLY, model, session_id) as record:
+            content = provider.complete(
+                [{"role": "user", "content": prompt}],
+                task=llm_provider.TASK_SMART_REPLY, model=model, temperature=0.5
+            )
+            record.prompt_tokens = context.count_tokens(prompt)
+            record.completion_tokens = context.count_tokens(content)
+        content = content.strip()
         content = content.replace("\n", "").replace('"', "").replace("'", "")
         options = content.split("|")
         
@@ -264,17 +282,271 @@ def generate_smart_replies(last_ai_question):
     except Exception as e:
         return ["是", "否", "不清楚"]
 
+def start_smart_replies(question):
+    """先用本地规则生成选项，规则覆盖不了的问句交给后台线程调用大模型"""
+    options = smart_reply.quick_replies(question)
+    if options:
+        get_consultation().suggested_options = options
+        st.session_state.reply_future = None
+    else:
+        get_consultation().suggested_options = []
+        st.session_state.reply_future = smart_reply.submit(question, partial(generate_smart_replies, session_id=st.session_state.session_id))
+
+@st.fragment(run_every=0.5)
+def wait_smart_replies():
+    """后台选项生成完成后刷新页面，把按钮补上"""
+    future = st.session_state.reply_future
+    if future is None or future.done():
+        if future is not None:
+            consult = get_consultation()
+            consult.suggested_options = future.result()
+            session_store.get_store().save(consult)
+            st.session_state.reply_future = None
+        st.rerun()
+    st.caption("正在为您准备回答选项...")
+
+def cancel_smart_replies():
+    """放弃尚未开始的后台选项生成"""
+    future = st.session_state.reply_future
+    if future is not None:
+        future.cancel()
+        st.session_state.reply_future = None
+
 def reset_chat():
-    del st.session_state["messages"]
-    st.session_state.turn_count = 0
-    st.session_state.suggested_options = []
-    init_state()
-    st.session_state.stage = 0
-    st.rerun()
+    """开始新问诊（按钮回调，执行完后页面自动重跑一次）；旧问诊仍保留在存储中，未写完的回复不再生成"""
+    generation_worker.get_worker().cancel(st.session_state.session_id)
+    st.session_state.session_id = session_store.get_store().create().session_id
+    cancel_smart_replies()
+    cancel_image()
+    st.query_params["sid"] = st.session_state.session_id
+
+def refresh_tip():
+    st.session_state.current_tip = get_ai_health_tip()
+
+def handle_user_input(text):
+    """记录用户回答（按钮/输入框回调）；回调结束后 Streamlit 会自动重跑，无需再手动 st.rerun()"""
+    store = session_store.get_store()
+    # 与后台写回回复共用会话锁：要么回复先写完再记这条回答，要么回复被取消、不再写回
+    with store.lock(st.session_state.session_id):
+        consult = get_consultation()
+        # 上一条回复还在生成时用户又输入了内容：放弃那条回复，按新的输入重新生成
+        generation_worker.get_worker().cancel(consult.session_id)
+        consult.add_user_input(text)
+        store.save(consult)
+    st.session_state.reply_future = None
+
+def select_image_kind(kind):
+    """选择照片类型（再点一次收起上传框）"""
+    st.session_state.image_kind = None if st.session_state.image_kind == kind else kind
+    st.session_state.image_error = None
+
+def submit_image():
+    """上传框回调：照片交给后台线程池预处理和识别，页面脚本不等待"""
+    key = f"image_upload_{st.session_state.image_upload_seq}"
+    uploaded = st.session_state.get(key)
+    if uploaded is None:
+        return
+    cancel_image()
+    st.session_state.image_future = image_pipeline.get_pipeline(api_key).submit(
+        st.session_state.session_id, st.session_state.image_kind, uploaded.getvalue()
+    )
+    st.session_state.image_error = None
+    st.session_state.image_upload_seq += 1
+
+def cancel_image():
+    """放弃尚未开始处理的照片"""
+    future = st.session_state.image_future
+    if future is not None:
+        future.cancel()
+        st.session_state.image_future = None
+
+@st.fragment(run_every=config.GENERATION_POLL_INTERVAL)
+def follow_image():
+    """照片识别完成后把结果作为一条用户消息写入问诊，整页重跑由 AI 接着问诊"""
+    future = st.session_state.image_future
+    if future is None or future.done():
+        st.session_state.image_future = None
+        if future is not None and not future.cancelled():
+            try:
+                handle_user_input(future.result().text)
+                st.session_state.image_kind = None
+            except image_pipeline.ImageError:
+                st.session_state.image_error = "⚠️ 无法读取这张照片，请换一张 JPG / PNG 照片重试。"
+            except Exception as e:
+                logger.warning("image analysis failed: %r", e)
+                st.session_state.image_error = "⚠️ 照片识别失败，请稍后重试。"
+        st.rerun()
+    st.caption("🔍 正在识别照片...")
+
+def submit_chat_input():
+    if st.session_state.chat_input:
+        handle_user_input(st.session_state.chat_input)
+
+def render_message(message):
+    """渲染一条消息；系统提示和生成报告的隐藏指令不显示"""
+    if message["role"] == "system" or message["content"] == CMD_GENERATE_REPORT:
+        return
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
+
+def local_reply(consult, report):
+    """大模型不可用时的本地回复：报告由知识库整理，问诊按“十问”继续，追问如实告知"""
+    query = knowledge_base.symptom_query(consult.messages)
+    if report:
+        return report_engine.offline_report(query)
+    if consult.stage == 2:
+        return OFFLINE_FOLLOW_UP
+    asked = [m["content"] for m in consult.messages if m["role"] == "assistant"]
+    for question in OFFLINE_QUESTIONS:
+        if not any(question in text for text in asked):
+            return f"{OFFLINE_QUESTION_NOTE}\n\n{question}"
+    # 本地问题都已问过，直接给出本地资料整理的报告
+    return report_engine.offline_report(query)
+
+def start_reply(consult):
+    """把本轮回复交给后台生成；生成完毕后由后台写回问诊记录，页面刷新或断线都不影响"""
+    session_id = consult.session_id
+    # 判断是否正在生成报告（通过轮次 或 指令 或 状态）
+    is_generating_report_cmd = consult.wants_report()
+    model = llm_router.model_for(llm_provider.TASK_CHAT)
+
+    # 固定文本的提问先查缓存，命中则直接回放，不占用上游名额
+    cache_key = None
+    cached = None
+    if consult.messages[-1]["content"] in CACHEABLE_PROMPTS:
+        cache_key = response_cache.make_key(consult.messages, model=model, temperature=0.8)
+        cached = response_cache.get_cache().get(cache_key)
+    # 分板块生成报告时每个板块各自占用上游名额
+    parallel_report = cached is None and is_generating_report_cmd and config.REPORT_PARALLEL
+    payload = None
+    query = None
+    if cached is None:
+        payload = context.build_context(consult.messages)
+        if is_generating_report_cmd:
+            # 按完整问诊记录检索本地知识库，附进报告请求
+            query = knowledge_base.symptom_query(consult.messages)
+            if not parallel_report:
+                payload = report_engine.with_references(payload, query)
+
+    def open_stream(on_wait):
+        if cached is not None:
+            return response_cache.replay(cached)
+        if parallel_report:
+            return report_engine.ReportStream(
+                provider, payload, session_id=session_id,
+                model=llm_router.model_for(llm_provider.TASK_REPORT_SECTION), temperature=0.8,
+                on_wait=on_wait, query=query
+            )
+        return provider.stream(payload, task=llm_provider.TASK_CHAT, model=model, temperature=0.8)
+
+    def fallback(error, partial_reply):
+        # 上游重试用尽、超时或熔断：已输出一半的补一句说明，还没有输出的改用本地回复，问诊不中断
+        metrics.metrics.record_route_event("fallback", llm_provider.TASK_CHAT, model, error=type(error).__name__)
+        if partial_reply:
+            return [f"\n\n{INTERRUPTED_NOTE}"]
+        return response_cache.replay(local_reply(consult, is_generating_report_cmd))
+
+    def on_event(generation, event):
+        # 在后台事件循环中调用，只做不阻塞的操作
+        if event == EVENT_QUESTION:
+            # 问句一输出完整就准备回答选项：本地规则解析不了的立即交给后台调用大模型，不等整段回复结束
+            question = generation.detector.question
+            if smart_reply.quick_replies(question) is None:
+                generation.options = smart_reply.submit(question, partial(generate_smart_replies, session_id=session_id))
+        elif event == EVENT_REPORT and generation.options is not None:
+            # AI 开始写报告，回答选项用不上了：还没开始调用的直接取消
+            generation.options.cancel()
+            generation.options = None
+
+    def finish(generation):
+        full_response = generation.text
+        record = metrics.CallRecord(
+            task=llm_provider.TASK_CHAT, model=model, session_id=session_id, ttft=generation.ttft,
+            duration=time.monotonic() - generation.started_at, cache_hit=cached is not None, error=generation.error,
+        )
+        # 分板块报告的 token 已按板块逐条记录，这里只记首字与总耗时，否则同一份报告的 token 会计两遍
+        if not parallel_report:
+            if cached is None:
+                record.prompt_tokens, record.completion_tokens = metrics.usage_tokens(generation.usage)
+                if record.prompt_tokens is None:
+                    record.prompt_tokens = context.count_messages_tokens(payload)
+            if record.completion_tokens is None:
+                record.completion_tokens = context.count_tokens(full_response)
+        metrics.metrics.record_call(record)
+        if generation.cancelled:
+            # 已被新的输入或新问诊取消：内容可能不完整，不写缓存也不写回
+            return
+        if cache_key and cached is None and generation.error is None:
+            response_cache.get_cache().put(cache_key, full_response)
+
+        # 后台写回时以存储中的问诊为准（生成期间会话可能已被换出）；
+        # 检查轮次、追加回复、保存都在会话锁内完成，期间用户的新输入会等写回结束或先取消本次生成
+        store = session_store.get_store()
+        with store.lock(session_id):
+            if generation.cancelled:
+                return
+            current = store.get(session_id)
+            if current is None or len(current.messages) != generation.turn:
+                return
+            # [修改点 4] 智能检测：流式过程中识别出“深度辨证”等报告标题，说明 AI 自动决定生成报告了
+            current.add_reply(full_response, report=is_generating_report_cmd or generation.report_started)
+            if current.stage == 1:
+                # 问句能用本地规则解析的直接备好选项；解析不了的由页面交给大模型
+                current.suggested_options = smart_reply.quick_replies(smart_reply.extract_question(full_response)) or []
+            store.save(current)
+
+    return generation_worker.get_worker().submit(
+        session_id, len(consult.messages), open_stream,
+        # 缓存回放不占名额；分板块报告由各板块自行占用
+        limit=cached is None and not parallel_report,
+        self_limited=parallel_report,
+        # 只在问诊阶段识别：报告阶段的追问回复不需要回答选项
+        detect_stage=consult.stage == 1 and not is_generating_report_cmd,
+        fallback=fallback, on_event=on_event, on_finish=finish,
+    )
+
+@st.fragment(run_every=config.GENERATION_POLL_INTERVAL)
+def follow_reply(frozen_upto, report):
+    """定时读取后台生成的内容，只重绘正在书写的板块（前 frozen_upto 个字符已由聊天区渲染）；
+    又有板块写完或生成结束后整页重跑，已写完的板块只随整页重跑发送一次"""
+    generation = generation_worker.get_worker().get(st.session_state.session_id)
+    if generation is None or generation.done:
+        st.rerun()
+    frozen, active = split_sections(generation.text)
+    if len(frozen) > frozen_upto:
+        st.rerun()
+    # 是否在生成报告由聊天区按问诊状态算好传入，轮询时不再查询存储
+    report = report or generation.report_started
+    if report and not frozen_upto:
+        # AI 自行开始写报告时也在此处提示
+        st.caption("💡 等候期间，可查看左侧「养生锦囊」获取实用小知识")
+    if active:
+        renderer = StreamRenderer()
+        renderer.write(active)
+        renderer.flush()
+    elif generation.position:
+        st.caption(f"⏳ 当前咨询人数较多，正在排队（前方还有 {generation.position} 个请求）...")
+    elif not frozen_upto:
+        st.caption("🌿 小助手正在查阅古籍，撰写深度诊断报告..." if report else "思考中...")
 
 init_state()
+# 首次运行即创建锦囊池，让后台线程提前开始补货
+get_tip_pool()
 
 # ================= 3. 侧边栏 =================
+# 锦囊卡片单独成片段：换一条只重跑这一小块，不牵动聊天区
+@st.fragment
+def tip_card():
+    st.markdown(f"""
+    <div style="background:#fff; padding:15px; border-radius:8px; border-left:4px solid #8d6e63; box-shadow:0 2px 5px rgba(0,0,0,0.05);">
+        <div style="font-weight:bold; color:#8d6e63; margin-bottom:5px;">💡 中医养生锦囊</div>
+        <div style="font-size:13px; color:#555;">{st.session_state.current_tip}</div>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    # 换一换按钮逻辑
+    st.button("🔄 获取新知识", on_click=refresh_tip)
+
 with st.sidebar:
     st.markdown("""
     <div style="color:#8d6e63; font-weight:bold; font-size:18px;">
@@ -282,38 +554,29 @@ with st.sidebar:
     </div>
     """, unsafe_allow_html=True)
     
-    if st.button("🔄 开始新问诊", type="primary", use_container_width=True):
-        reset_chat()
-    
-    if st.session_state.stage == 1:
-        st.caption(f"问诊进度 (最大 {MAX_TURNS} 轮)")
-        # 进度条只是视觉参考
-        st.progress(min(st.session_state.turn_count / MAX_TURNS, 1.0))
+    st.button("🔄 开始新问诊", type="primary", use_container_width=True, on_click=reset_chat)
     
     st.markdown("---")
-    st.caption("🛠️ 辅助功能 (待上线)")
-    col_mock1, col_mock2 = st.columns(2)
-    col_mock1.button("👅 AI舌诊", disabled=True, use_container_width=True)
-    col_mock2.button("😐 AI面诊", disabled=True, use_container_width=True)
-    col_mock3, col_mock4 = st.columns(2)
-    col_mock3.button("📄 拍报告", disabled=True, use_container_width=True)
-    col_mock4.button("💊 拍药盒", disabled=True, use_container_width=True)
+    st.caption("🛠️ 辅助功能")
+    image_buttons = list(IMAGE_BUTTONS.items())
+    for row in (image_buttons[:2], image_buttons[2:]):
+        for col, (label, kind) in zip(st.columns(2), row):
+            col.button(label, use_container_width=True, on_click=select_image_kind, args=(kind,),
+                       type="primary" if st.session_state.image_kind == kind else "secondary")
+    if st.session_state.image_kind is not None:
+        st.file_uploader(
+            IMAGE_HINTS[st.session_state.image_kind], type=["jpg", "jpeg", "png", "webp"],
+            key=f"image_upload_{st.session_state.image_upload_seq}", on_change=submit_image,
+        )
+    if st.session_state.image_future is not None:
+        follow_image()
+    if st.session_state.image_error:
+        st.warning(st.session_state.image_error)
     
     st.markdown("---")
     
     # 养生一签区域
-    st.markdown(f"""
-    <div style="background:#fff; padding:15px; border-radius:8px; border-left:4px solid #8d6e63; box-shadow:0 2px 5px rgba(0,0,0,0.05);">
-        <div style="font-weight:bold; color:#8d6e63; margin-bottom:5px;">💡 中医养生锦囊</div>
-        <div style="font-size:13px; color:#555;">{st.session_state.current_tip}</div>
-    </div>
-    """, unsafe_allow_html=True)
-    
-    # 换一换按钮逻辑
-    if st.button("🔄 获取新知识"):
-        with st.spinner("AI正在查阅医书..."): 
-            st.session_state.current_tip = get_ai_health_tip()
-        st.rerun()
+    tip_card()
         
     st.markdown(
         """
@@ -325,122 +588,151 @@ with st.sidebar:
     )
 
 # ================= 4. 主逻辑控制 =================
+# 整页重跑时才渲染已定稿的历史；之后点选项、追问只重跑下方的聊天片段，
+# 片段里只渲染本次整页重跑之后新增的消息，历史越长省得越多；每条回复生成完毕时整页重跑一次并入历史
+
 st.title("🌿 中医智能小助手")
 
-# 渲染历史
-for message in st.session_state.messages:
-    if message["role"] != "system":
-        # 如果消息内容是生成报告的隐藏指令，则跳过显示
-        if message["content"] == CMD_GENERATE_REPORT:
-            continue
-        
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+consult = get_consultation()
+st.session_state.history_upto = len(consult.messages)
+for message in consult.messages:
+    render_message(message)
 
-def handle_user_input(text):
-    st.session_state.messages.append({"role": "user", "content": text})
-    
-    if st.session_state.stage == 0:
-        st.session_state.stage = 1
-    
-    if st.session_state.stage == 1:
-        st.session_state.turn_count += 1
-        # [修改] 只有在达到绝对最大上限时才强制触发，否则交给 AI 或用户按钮决定
-        if st.session_state.turn_count >= MAX_TURNS:
-            st.session_state.messages.append({
-                "role": "user", 
-                "content": CMD_GENERATE_REPORT
-            })
-    st.rerun()
-
-# 1. 首页
-if st.session_state.stage == 0 and len(st.session_state.messages) <= 2:
-    st.markdown("### 您可能有以下困扰？")
-    st.markdown('<div class="start-screen-buttons">', unsafe_allow_html=True)
-    col1, col2, col3, col4 = st.columns(4)
-    if col1.button("😴 睡不着"): handle_user_input("我最近总是睡不着")
-    if col2.button("💇‍♀️ 掉头发"): handle_user_input("我最近掉头发很严重")
-    if col3.button("❄️ 手脚凉"): handle_user_input("我手脚总是冰凉")
-    if col4.button("🤢 胃胀气"): handle_user_input("我经常胃胀气")
-    st.markdown('</div>', unsafe_allow_html=True)
-
-# 2. AI 回复
-if st.session_state.messages[-1]["role"] == "user":
-    with st.chat_message("assistant"):
-        # 判断是否正在生成报告（通过轮次 或 指令 或 状态）
-        is_generating_report_cmd = st.session_state.turn_count >= MAX_TURNS or CMD_GENERATE_REPORT in st.session_state.messages[-1]["content"]
-        
-        spinner_text = "🌿 小助手正在查阅古籍，撰写深度诊断报告..." if is_generating_report_cmd else "思考中..."
+@st.fragment
+def chat_area():
+    started = time.perf_counter()
+    chat_body()
+    # 整页运行中的这一次已计入整页重跑耗时；点选项、追问等只重跑本片段时单独记录
+    if _run_finished:
+        metrics.metrics.record_rerun(st.session_state.session_id, time.perf_counter() - started, scope=metrics.RERUN_FRAGMENT)
 
-        if is_generating_report_cmd:
-            st.caption("💡 等候期间，可查看左侧「养生锦囊」获取实用小知识")
-        
-        with st.spinner(spinner_text):
-            response = client.chat.completions.create(
-                model="glm-4", messages=st.session_state.messages, stream=True, temperature=0.8
-            )
-            placeholder = st.empty()
-            full_response = ""
-            for chunk in response:
-                if chunk.choices[0].delta.content:
-                    full_response += chunk.choices[0].delta.content
-                    placeholder.markdown(full_response + " ▌")
-            placeholder.markdown(full_response)
-            
-            st.session_state.messages.append({"role": "assistant", "content": full_response})
-            
-            # [修改点 4] 智能检测：如果 AI 的回复里包含了“深度辨证”等报告关键词，说明 AI 自动决定生成报告了
-            ai_decided_to_report = "### 🩺 深度辨证" in full_response or "### 深度辨证" in full_response
-            
-            if is_generating_report_cmd or ai_decided_to_report:
-                st.session_state.stage = 2
-                st.session_state.suggested_options = []
+def chat_body():
+    consult = get_consultation()
+    # 上次整页重跑之后新增的消息
+    for message in consult.messages[st.session_state.history_upto:]:
+        render_message(message)
+
+    # 1. 首页
+    if consult.stage == 0 and len(consult.messages) <= 2:
+        st.markdown("### 您可能有以下困扰？")
+        st.markdown('<div class="start-screen-buttons">', unsafe_allow_html=True)
+        for col, (label, text) in zip(st.columns(4), STARTER_PROMPTS.items()):
+            col.button(label, on_click=handle_user_input, args=(text,))
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    # 2. AI 回复：在后台生成，这里只跟读缓冲区；刷新页面后按会话编号接上原来的生成，不会重复请求
+    if consult.messages[-1]["role"] == "user":
+        worker = generation_worker.get_worker()
+        generation = worker.get(consult.session_id)
+        if consult.messages[-1]["role"] != "user":
+            # 取生成状态的同时回复恰好在后台写回完毕
+            st.rerun()
+        if generation is not None and generation.turn == len(consult.messages) and generation.failed:
+            st.error("⚠️ 回复生成失败，请稍后重试。")
+            st.button("🔁 重新生成", on_click=worker.cancel, args=(consult.session_id,))
+            return
+        if generation is None or generation.done or generation.turn != len(consult.messages):
+            generation = start_reply(consult)
+        with st.chat_message("assistant"):
+            # 已写完的板块只在这里渲染一次，跟读片段每次轮询只重绘正在书写的板块
+            frozen, _ = split_sections(generation.text)
+            if frozen:
+                st.markdown(frozen)
+            follow_reply(len(frozen), consult.wants_report())
+        return
+
+    # 3. 问诊中
+    if consult.stage == 1:
+        if consult.messages[-1]["role"] == "assistant" and not consult.suggested_options and st.session_state.reply_future is None:
+            question = smart_reply.extract_question(consult.messages[-1]["content"])
+            generation = generation_worker.get_worker().get(consult.session_id)
+            early = None
+            if generation is not None and generation.turn == len(consult.messages) - 1:
+                early = generation.options
+            if early is not None and generation.detector.question == question:
+                # 回复流式输出途中已为这个问句开始准备选项，接着等它即可
+                st.session_state.reply_future = early
+            else:
+                if early is not None:
+                    # 回复最后的问句与途中识别的不一致，提前准备的选项作废
+                    early.cancel()
+                # 途中没有提前准备（如从存储续接的会话），按最后一条提问重新准备选项
+                start_smart_replies(question or consult.messages[-1]["content"])
+        # 后台选项已生成完毕则直接取用；不能留给轮询片段去触发重跑，否则会吞掉本次按钮点击
+        if st.session_state.reply_future is not None and st.session_state.reply_future.done():
+            consult.suggested_options = st.session_state.reply_future.result()
+            st.session_state.reply_future = None
+        if consult.messages[-1]["role"] == "assistant" and (consult.suggested_options or st.session_state.reply_future):
+            # 进度放在聊天片段里，随每轮回答即时更新
+            st.caption(f"问诊进度 (最大 {MAX_TURNS} 轮)")
+            # 进度条只是视觉参考
+            st.progress(min(consult.turn_count / MAX_TURNS, 1.0))
+            st.caption(f"请选择您的具体情况，或手动输入 (当前第 {consult.turn_count} 轮)")
+            if consult.suggested_options:
+                cols = st.columns(len(consult.suggested_options))
+                for i, option in enumerate(consult.suggested_options):
+                    cols[i].button(option, on_click=handle_user_input, args=(option,))
             else:
-                st.session_state.suggested_options = generate_smart_replies(full_response)
+                wait_smart_replies()
             
-            st.rerun()
+            st.markdown("---")
+            # [修改点 5] 用户主动触发按钮：发送隐形指令
+            st.button("✅ 结束问诊，生成养生诊断报告", type="primary", use_container_width=True,
+                      on_click=handle_user_input, args=(CMD_GENERATE_REPORT,))
 
-# 3. 问诊中
-if st.session_state.stage == 1:
-    if st.session_state.messages[-1]["role"] == "assistant" and st.session_state.suggested_options:
-        st.caption(f"请选择您的具体情况，或手动输入 (当前第 {st.session_state.turn_count} 轮)")
-        cols = st.columns(len(st.session_state.suggested_options))
-        for i, option in enumerate(st.session_state.suggested_options):
-            if cols[i].button(option):
-                handle_user_input(option)
+    # 4. 结果页
+    if consult.stage == 2:
+        st.success("✅ 深度诊断报告已生成")
         
-        st.markdown("---")
-        # [修改点 5] 用户主动触发按钮
-        if st.button("✅ 结束问诊，生成养生诊断报告", type="primary", use_container_width=True):
-            # 发送隐形指令
-            handle_user_input(CMD_GENERATE_REPORT)
-
-# 4. 结果页
-if st.session_state.stage == 2:
-    st.success("✅ 深度诊断报告已生成")
-    
-    report_content = st.session_state.messages[-1]["content"]
-    
-    col_dl1, col_dl2 = st.columns([1, 4])
-    with col_dl1:
-        st.download_button(
-            label="📥 下载诊断报告",
-            data=report_content,
-            file_name="中医AI诊断报告.md",
-            mime="text/markdown",
-            use_container_width=True
-        )
-    
-    st.caption("您可以继续追问详情：")
-    c1, c2, c3, c4 = st.columns(4)
-    if c1.button("🍲 七日食谱"): handle_user_input("请推荐一个适合我的七天食谱，要有具体做法。")
-    if c2.button("🚫 详细忌口"): handle_user_input("请列出我绝对不能吃的食物清单。")
-    if c3.button("🍵 茶饮调理"): handle_user_input("日常适合喝什么茶？")
-    if c4.button("💆 更多穴位"): handle_user_input("针对我的症状，日常可以按摩哪些穴位")
+        report_content = consult.messages[-1]["content"]
+        
+        col_dl1, col_dl2 = st.columns([1, 4])
+        with col_dl1:
+            st.download_button(
+                label="📥 下载诊断报告",
+                data=report_content,
+                file_name="中医AI诊断报告.md",
+                mime="text/markdown",
+                use_container_width=True,
+                on_click="ignore"
+            )
+        
+        st.caption("您可以继续追问详情：")
+        for col, (label, text) in zip(st.columns(4), FOLLOW_UP_PROMPTS.items()):
+            col.button(label, on_click=handle_user_input, args=(text,))
 
-# 5. 输入框
-if prompt := st.chat_input("输入回答..."):
-    handle_user_input(prompt)
+    session_store.get_store().save(consult)
+
+chat_area()
 
+# 5. 输入框
+st.chat_input("输入回答...", key="chat_input", on_submit=submit_chat_input)
 
+# ================= 5. 性能指标 =================
+# 调试面板需显式开启：环境变量 ZY_DEBUG_PANEL=1 或网址加 ?debug=1
+if config.DEBUG_PANEL or st.query_params.get("debug") == "1":
+    calls, reruns = metrics.metrics.session_snapshot(st.session_state.session_id)
+    with st.sidebar.expander("🔧 性能调试", expanded=False):
+        for scope, label in ((metrics.RERUN_APP, "页面重跑"), (metrics.RERUN_FRAGMENT, "聊天区重跑")):
+            durations = [d for s, d in reruns if s == scope]
+            if durations:
+                st.caption(f"{label}：最近 {durations[-1] * 1000:.0f} ms，平均 {sum(durations) / len(durations) * 1000:.0f} ms（{len(durations)} 次）")
+        if calls:
+            st.dataframe([
+                {
+                    "任务": c.task,
+                    "模型": c.model,
+                    "首字(s)": None if c.ttft is None else round(c.ttft, 2),
+                    "总耗时(s)": None if c.duration is None else round(c.duration, 2),
+                    "tok/s": None if c.tokens_per_sec is None else round(c.tokens_per_sec, 1),
+                    "输入tok": c.prompt_tokens,
+                    "输出tok": c.completion_tokens,
+                    "缓存": "✓" if c.cache_hit else "",
+                }
+                for c in reversed(calls)
+            ], hide_index=True)
+        else:
+            st.caption("本会话暂无大模型调用记录")
 
+metrics.metrics.record_rerun(st.session_state.session_id, time.perf_counter() - _run_started)
+_run_finished = True
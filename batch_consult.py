@@ -0,0 +1,236 @@
+# ================= 批量问诊 =================
+# 合作机构成批发来的问卷不必逐个在界面上点：从 JSONL 读入每位患者预先写好的回答，
+# 沿用同一套系统提示词、轮次规则（MAX_TURNS、生成报告指令）和报告识别，在 asyncio 上限定并发同时问诊。
+# 每位患者的问诊记录和报告边生成边写入 Markdown，完成后追加一行到 results.jsonl；
+# results.jsonl 同时是断点记录，中断后重跑会跳过已成功的患者。
+#
+# 输入每行一位患者：{"id": "p001", "answers": ["我最近总是睡不着", "怕冷", "是", ...]}
+# 回答用完 AI 仍未给出报告时自动发送生成报告指令。
+# 用法（在仓库根目录执行）：
+#     ZY_API_KEY=... python batch_consult.py patients.jsonl --out batch_out --concurrency 8
+#     ZY_LLM_PROVIDER=stub python batch_consult.py examples/patients.jsonl   # 无 Key 时用本地桩试跑
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+import config
+import context
+import knowledge_base
+import llm_client
+import llm_provider
+import llm_router
+import metrics
+import report_engine
+from generation_worker import aiter_stream
+from prompts import CMD_GENERATE_REPORT, initial_messages
+from session_store import Consultation
+from stage_detector import StageDetector
+
+logger = logging.getLogger("zhongyi.batch")
+
+RESULTS_FILE = "results.jsonl"
+REPORTS_DIR = "reports"
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+
+# 患者编号转文件名时替换掉的字符
+_UNSAFE_RE = re.compile(r"[^\w.-]")
+
+
+def load_patients(path):
+    """读入患者列表；每行需有 id 和非空的 answers 列表"""
+    patients = []
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            patient = json.loads(line)
+            answers = patient.get("answers")
+            if not patient.get("id") or not isinstance(answers, list) or not answers:
+                raise ValueError(f"{path}:{lineno}: each line needs an id and a non-empty answers list")
+            patients.append(patient)
+    return patients
+
+
+def finished_ids(out_dir):
+    """断点：results.jsonl 中最近一次结果为成功的患者"""
+    status = {}
+    path = os.path.join(out_dir, RESULTS_FILE)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # 上次中断时写了一半的行
+                    continue
+                status[result["id"]] = result["status"]
+    return {patient_id for patient_id, s in status.items() if s == STATUS_OK}
+
+
+class BatchRunner:
+    """限定并发的批量问诊"""
+
+    def __init__(self, provider, out_dir, concurrency):
+        self._provider = provider
+        self._out_dir = out_dir
+        self._concurrency = concurrency
+        self._reports_dir = os.path.join(out_dir, REPORTS_DIR)
+        os.makedirs(self._reports_dir, exist_ok=True)
+        path = os.path.join(out_dir, RESULTS_FILE)
+        self._results = open(path, "a+", encoding="utf-8")
+        # 上次中断时末行可能没写完，先补上换行，免得与新结果粘在一行
+        if self._results.tell() > 0:
+            self._results.seek(self._results.tell() - 1)
+            if self._results.read(1) != "\n":
+                self._results.write("\n")
+
+    async def run(self, patients):
+        """问诊全部未完成的患者，返回 (成功数, 失败数, 跳过数)"""
+        done = finished_ids(self._out_dir)
+        todo = [p for p in patients if str(p["id"]) not in done]
+        # 每个问诊同一时刻最多占一个线程（取下一段回复或排队等上游名额）
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="batch")
+        )
+        semaphore = asyncio.Semaphore(self._concurrency)
+        counts = {STATUS_OK: 0, STATUS_ERROR: 0}
+
+        async def one(patient):
+            async with semaphore:
+                result = await self.consult(patient)
+            self._write_result(result)
+            counts[result["status"]] += 1
+            logger.info("[%d/%d] %s %s %.1fs%s", counts[STATUS_OK] + counts[STATUS_ERROR], len(todo),
+                        result["id"], result["status"], result["duration"],
+                        f" ({result['error']})" if result["error"] else "")
+
+        logger.info("batch: %d patients, %d already finished, concurrency=%d",
+                    len(patients), len(patients) - len(todo), self._concurrency)
+        await asyncio.gather(*(one(p) for p in todo))
+        return counts[STATUS_OK], counts[STATUS_ERROR], len(patients) - len(todo)
+
+    async def consult(self, patient):
+        """按预设回答走完一次问诊，问诊记录边生成边写入 Markdown"""
+        patient_id = str(patient["id"])
+        consult = Consultation(f"batch-{patient_id}", initial_messages())
+        answers = list(patient["answers"])
+        md_path = os.path.join(self._reports_dir, _UNSAFE_RE.sub("_", patient_id) + ".md")
+        started = time.monotonic()
+        error = None
+        with open(md_path + ".part", "w", encoding="utf-8") as md:
+            md.write(f"# 中医问诊记录：{patient_id}\n\n")
+            try:
+                while consult.stage != 2:
+                    # 回答用完仍在问诊时，与界面上的“结束问诊”按钮一样发送生成报告指令
+                    text = answers.pop(0) if answers else CMD_GENERATE_REPORT
+                    consult.add_user_input(text)
+                    if text != CMD_GENERATE_REPORT:
+                        md.write(f"**患者**：{text}\n\n")
+                    report = consult.wants_report()
+                    md.write("---\n\n" if report else "**小助手**：")
+                    detector = StageDetector()
+                    pieces = []
+                    async for piece in self._reply(consult, report):
+                        pieces.append(piece)
+                        md.write(piece)
+                        md.flush()
+                        # 与界面一致：问诊阶段 AI 自行开始写报告即视为报告
+                        if not report:
+                            detector.feed(piece)
+                    md.write("\n\n")
+                    consult.add_reply("".join(pieces), report=report or detector.report)
+            except Exception as e:
+                logger.warning("patient %s failed: %r", patient_id, e)
+                error = f"{type(e).__name__}: {e}"
+        if error is None:
+            os.replace(md_path + ".part", md_path)
+        return {
+            "id": patient_id,
+            "status": STATUS_ERROR if error else STATUS_OK,
+            "turns": consult.turn_count,
+            "report": consult.messages[-1]["content"] if consult.stage == 2 else None,
+            "markdown": os.path.relpath(md_path if error is None else md_path + ".part", self._out_dir),
+            "messages": [m for m in consult.messages if m["role"] != "system"],
+            "duration": round(time.monotonic() - started, 3),
+            "error": error,
+            "ts": time.time(),
+        }
+
+    async def _reply(self, consult, report):
+        """生成一轮回复，与界面相同：报告分板块并行生成并附本地知识库资料，其余对话占一个上游名额"""
+        session_id = consult.session_id
+        model = llm_router.model_for(llm_provider.TASK_CHAT)
+        payload = context.build_context(consult.messages)
+        with ExitStack() as stack:
+            if report:
+                query = knowledge_base.symptom_query(consult.messages)
+            sections = report and config.REPORT_PARALLEL
+            if sections:
+                stream = report_engine.ReportStream(
+                    self._provider, payload, session_id=session_id,
+                    model=llm_router.model_for(llm_provider.TASK_REPORT_SECTION), temperature=0.8, query=query
+                )
+            else:
+                await asyncio.to_thread(stack.enter_context, llm_client.limiter.slot(session_id))
+                if report:
+                    payload = report_engine.with_references(payload, query)
+                stream = self._provider.stream(payload, task=llm_provider.TASK_CHAT, model=model, temperature=0.8)
+            record = stack.enter_context(metrics.track_call(llm_provider.TASK_CHAT, model, session_id))
+            text = []
+            async for piece in aiter_stream(stream):
+                text.append(piece)
+                yield piece
+            record.ttft = stream.ttft
+            if sections:
+                # 各板块的 token 已单独记录，这里只记耗时，不重复计数
+                return
+            record.prompt_tokens, record.completion_tokens = metrics.usage_tokens(stream.usage)
+            if record.prompt_tokens is None:
+                record.prompt_tokens = context.count_messages_tokens(payload)
+            if record.completion_tokens is None:
+                record.completion_tokens = context.count_tokens("".join(text))
+
+    def _write_result(self, result):
+        # 每条结果落盘后才算完成，中断后据此续跑
+        self._results.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self._results.flush()
+        os.fsync(self._results.fileno())
+
+    def close(self):
+        self._results.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量问诊：从 JSONL 读入患者回答，并发生成诊断报告")
+    parser.add_argument("patients", help="患者回答文件（JSONL，每行 {\"id\": ..., \"answers\": [...]}）")
+    parser.add_argument("--out", default="batch_out", help="输出目录：results.jsonl 与 reports/*.md")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时进行的问诊数")
+    parser.add_argument("--api-key", default=os.environ.get("ZY_API_KEY"), help="智谱 API Key（默认取 ZY_API_KEY）")
+    args = parser.parse_args(argv)
+    if config.LLM_PROVIDER != "stub" and not args.api_key:
+        parser.error("missing API key: pass --api-key or set ZY_API_KEY (or ZY_LLM_PROVIDER=stub)")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    patients = load_patients(args.patients)
+    runner = BatchRunner(llm_router.get_provider(args.api_key), args.out, max(1, args.concurrency))
+    try:
+        ok, failed, skipped = asyncio.run(runner.run(patients))
+    except KeyboardInterrupt:
+        print(f"interrupted: finished patients are recorded in {args.out}/{RESULTS_FILE}, rerun to resume")
+        return 130
+    finally:
+        runner.close()
+    print(f"done: {ok} ok, {failed} failed, {skipped} skipped (already finished) -> {args.out}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""照片上传链路压测：用本地桩代替视觉模型，离线测量预处理与识别缓存的效果。
+
+生成若干张手机尺寸、带 EXIF 的合成照片，按 --dup-rate 混入重复上传
+（原图再传一次，或重新压缩、轻微裁剪、调亮后的近似照片），按 --recolour-rate 混入
+构图相同、颜色不同的照片（好比同一角度拍的淡白舌与红舌，不应命中缓存）；
+每张原图及其变体属于同一会话。经线程池并发送入照片处理流水线，统计上传/预处理后大小、
+预处理耗时 p50/p95、缓存命中率（及把不同照片误判为同一张的次数）、识别调用次数和吞吐量。
+
+用法（在仓库根目录执行）：
+    python benchmarks/image_bench.py --photos 40 --dup-rate 0.3 --recolour-rate 0.1 --workers 4 --latency 0.8
+"""
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# 必须在导入项目模块之前设置，保证整个进程使用本地桩，指标写入临时目录
+os.environ["ZY_VISION_PROVIDER"] = "stub"
+_TMP_DIR = tempfile.mkdtemp(prefix="zy-image-bench-")
+os.environ.setdefault("ZY_METRICS_LOG_PATH", os.path.join(_TMP_DIR, "metrics.jsonl"))
+os.environ.setdefault("ZY_METRICS_PROM_PATH", os.path.join(_TMP_DIR, "metrics.prom"))
+
+from PIL import Image, ImageDraw, ImageEnhance  # noqa: E402
+
+import config  # noqa: E402
+import image_pipeline  # noqa: E402
+import vision  # noqa: E402
+
+# 合成照片的尺寸：常见手机竖拍 1200 万像素
+PHOTO_SIZE = (3024, 4032)
+
+
+def synthetic_photo(rng):
+    """渐变底色上叠加若干随机色块，结构足够区分不同照片"""
+    width, height = PHOTO_SIZE
+    image = Image.linear_gradient("L").rotate(rng.choice((0, 90, 180, 270))).resize(PHOTO_SIZE).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(8, 16)):
+        x, y, r = rng.randrange(width), rng.randrange(height), rng.randrange(200, 1400)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    return image
+
+
+def encode(image, quality):
+    """编码为带 EXIF（拍摄方向、设备、GPS 占位）的 JPEG，模拟手机原图"""
+    exif = Image.Exif()
+    exif[0x0112] = 1            # 拍摄方向
+    exif[0x010F] = "BenchPhone"  # 设备厂商
+    exif[0x8825] = {1: "N", 3: "E"}  # GPS 信息
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=quality, exif=exif)
+    return out.getvalue()
+
+
+def near_duplicate(image, rng):
+    """同一张照片的轻微变体：四周裁掉一点、亮度微调"""
+    width, height = image.size
+    margin = rng.randint(10, 40)
+    cropped = image.crop((margin, margin, width - margin, height - margin))
+    return ImageEnhance.Brightness(cropped).enhance(rng.uniform(0.95, 1.08))
+
+
+def recoloured(image):
+    """构图不变、只换颜色：交换红蓝通道"""
+    red, green, blue = image.split()
+    return Image.merge("RGB", (blue, green, red))
+
+
+# 上传类型
+ORIGINAL, DUPLICATE, RECOLOURED = "original", "duplicate", "recoloured"
+
+
+def build_uploads(photos, dup_rate, recolour_rate, kind, rng):
+    """返回 [(原照片编号, 照片类型, 照片数据, 上传类型)]"""
+    originals = []
+    uploads = []
+    for i in range(photos):
+        roll = rng.random()
+        if originals and roll < dup_rate:
+            index, image = rng.choice(originals)
+            if rng.random() < 0.5:
+                data = encode(image, 92)
+            else:
+                data = encode(near_duplicate(image, rng), rng.choice((75, 85, 95)))
+            uploads.append((index, data, DUPLICATE))
+        elif originals and roll < dup_rate + recolour_rate:
+            index, image = rng.choice(originals)
+            uploads.append((index, encode(recoloured(image), 92), RECOLOURED))
+        else:
+            image = synthetic_photo(rng)
+            originals.append((i, image))
+            uploads.append((i, encode(image, 92), ORIGINAL))
+    return [(index, kind, data, label) for index, data, label in uploads]
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="照片上传链路压测（本地桩，无需 API Key）")
+    parser.add_argument("--photos", type=int, default=40, help="上传的照片总数")
+    parser.add_argument("--dup-rate", type=float, default=0.3, help="重复或近似重复上传的比例")
+    parser.add_argument("--recolour-rate", type=float, default=0.1, help="构图相同、颜色不同的照片的比例")
+    parser.add_argument("--workers", type=int, default=config.IMAGE_WORKERS, help="处理线程数")
+    parser.add_argument("--latency", type=float, default=0.8, help="本地桩识别耗时（秒）")
+    parser.add_argument("--kind", default=vision.KIND_TONGUE, choices=sorted(vision.KINDS), help="照片类型")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="同时把结果写入该 JSON 文件")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    uploads = build_uploads(args.photos, args.dup_rate, args.recolour_rate, args.kind, rng)
+    backend = vision.StubVisionBackend(latency=args.latency)
+    cache = image_pipeline.PerceptualCache(config.IMAGE_CACHE_ITEMS, config.IMAGE_HASH_DISTANCE, config.IMAGE_COLOUR_DISTANCE)
+    pipeline = image_pipeline.ImagePipeline(backend, args.workers, cache)
+
+    # 原图先处理完，变体才可能命中缓存；按上传顺序分两批提交
+    first = [u for u in uploads if u[3] == ORIGINAL]
+    repeats = [u for u in uploads if u[3] != ORIGINAL]
+    duplicates = [u for u in repeats if u[3] == DUPLICATE]
+    started = time.perf_counter()
+    results = []
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for batch in (first, repeats):
+            results += list(pool.map(lambda u: (u, pipeline.process(f"bench-{u[0]}", u[1], u[2])), batch))
+    elapsed = time.perf_counter() - started
+
+    # 抽一张检查预处理后是否还留有 EXIF
+    sample = image_pipeline.preprocess(uploads[0][2])
+    exif_tags_left = len(Image.open(io.BytesIO(sample.data)).getexif())
+    upload_sizes = [r.upload_bytes for _, r in results]
+    prepared_sizes = [r.prepared_bytes for _, r in results]
+    preprocess = [r.preprocess_seconds for _, r in results]
+    hits = [u for u, r in results if r.cache_hit]
+    result = {
+        "photos": len(results),
+        "duplicates": len(duplicates),
+        "recoloured": len(repeats) - len(duplicates),
+        "workers": args.workers,
+        "wall_time_s": elapsed,
+        "photos_per_s": len(results) / elapsed,
+        "upload_kb_mean": statistics.fmean(upload_sizes) / 1024,
+        "prepared_kb_mean": statistics.fmean(prepared_sizes) / 1024,
+        "size_reduction": 1 - sum(prepared_sizes) / sum(upload_sizes),
+        "preprocess_p50_s": percentile(preprocess, 50),
+        "preprocess_p95_s": percentile(preprocess, 95),
+        "cache_hit_rate": len(hits) / len(results),
+        "duplicate_hit_rate": sum(1 for u in hits if u[3] == DUPLICATE) / len(duplicates) if duplicates else float("nan"),
+        "false_hits": sum(1 for u in hits if u[3] != DUPLICATE),
+        "vision_calls": backend.calls,
+        "exif_tags_left": exif_tags_left,
+    }
+    width = max(len(k) for k in result)
+    for key, value in result.items():
+        print(f"{key:<{width}}  {value:.3f}" if isinstance(value, float) else f"{key:<{width}}  {value}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
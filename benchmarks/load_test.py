@@ -0,0 +1,235 @@
+"""并发问诊压测：用本地桩代替大模型，无头驱动完整问诊流程。
+
+每个模拟患者依次经历：首页快捷入口 -> 若干轮问答 -> 诊断报告 -> 追问，
+统计首 token 延迟、页面重跑耗时、每轮耗时 p50/p95/p99 及单会话内存。
+Streamlit 的 AppTest 不支持同一进程内并发运行，因此按 --concurrency 启动多个
+工作进程，每个进程依次驱动分配给它的患者。
+
+用法（在仓库根目录执行）：
+    python benchmarks/load_test.py --sessions 20 --concurrency 10 --ttft 0.3 --tps 60
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "app.py")
+sys.path.insert(0, ROOT)
+# 必须在导入项目模块之前设置，保证整个进程使用本地桩和临时缓存
+os.environ["ZY_LLM_PROVIDER"] = "stub"
+_TMP_DIR = tempfile.mkdtemp(prefix="zy-bench-")
+os.environ.setdefault("ZY_CACHE_DB_PATH", os.path.join(_TMP_DIR, "responses.sqlite3"))
+os.environ.setdefault("ZY_SESSION_DB_PATH", os.path.join(_TMP_DIR, "sessions.sqlite3"))
+
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+import generation_worker  # noqa: E402
+import llm_provider  # noqa: E402
+import session_store  # noqa: E402
+from prompts import FOLLOW_UP_PROMPTS, STARTER_PROMPTS  # noqa: E402
+
+END_BUTTON = "✅ 结束问诊，生成养生诊断报告"
+# 每次轮询等待回答选项的间隔（秒）
+POLL_INTERVAL = 0.05
+
+
+class RecordingStub(llm_provider.StubProvider):
+    """记录每次流式调用的本地桩，用于统计首 token 延迟"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.streams = []
+        self._streams_lock = threading.Lock()
+
+    def stream(self, messages, *, task, model, temperature):
+        stream = super().stream(messages, task=task, model=model, temperature=temperature)
+        with self._streams_lock:
+            self.streams.append((task, stream))
+        return stream
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Patient:
+    """一个模拟患者的完整问诊流程"""
+
+    def __init__(self, seed, answer_turns, follow_ups, timeout):
+        self.rng = random.Random(seed)
+        self.answer_turns = answer_turns
+        self.follow_ups = follow_ups
+        self.timeout = timeout
+        self.turns = []    # 每轮（点击 -> 回复完成）耗时
+        self.reruns = []   # 无生成的页面重跑耗时
+        self.error = None
+        self.memory = 0
+        self.at = None
+
+    def _run(self, bucket):
+        start = time.perf_counter()
+        self.at.run()
+        bucket.append(time.perf_counter() - start)
+        if self.at.exception:
+            raise RuntimeError(self.at.exception[0].value)
+
+    def _labels(self):
+        return [b.label for b in self.at.button]
+
+    def _click(self, label):
+        self.at.button[self._labels().index(label)].click()
+        start = time.perf_counter()
+        self._run(self.reruns)
+        self._wait_reply()
+        self.turns.append(time.perf_counter() - start)
+        # 回复完成后再重跑一次，测量纯渲染开销
+        self._run(self.reruns)
+
+    def _wait_reply(self):
+        """回复在后台生成，页面只是定时跟读，轮询到生成结束为止"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            generation = generation_worker.get_worker().get(self.at.session_state.session_id)
+            if generation is None or generation.done:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError("等待回复超时")
+            time.sleep(POLL_INTERVAL)
+            self._run(self.reruns)
+
+    def _wait_options(self):
+        deadline = time.monotonic() + self.timeout
+        while END_BUTTON not in self._labels() or not self._options():
+            if time.monotonic() > deadline:
+                raise TimeoutError("等待回答选项超时")
+            time.sleep(POLL_INTERVAL)
+            self._run(self.reruns)
+
+    def _stage(self):
+        return session_store.get_store().get(self.at.session_state.session_id).stage
+
+    def _options(self):
+        skip = {END_BUTTON}
+        labels = self._labels()
+        end = labels.index(END_BUTTON) if END_BUTTON in labels else 0
+        return [label for label in labels[:end] if label not in skip]
+
+    def run(self):
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        try:
+            self.at = AppTest.from_file(APP, default_timeout=self.timeout)
+            self._run(self.reruns)
+            self._click(self.rng.choice(list(STARTER_PROMPTS)))
+            for _ in range(self.answer_turns):
+                if self._stage() == 2:
+                    break
+                self._wait_options()
+                self._click(self.rng.choice(self._options()))
+            if self._stage() != 2:
+                self._wait_options()
+                self._click(END_BUTTON)
+            for label in self.rng.sample(list(FOLLOW_UP_PROMPTS), self.follow_ups):
+                self._click(label)
+        except Exception as e:
+            self.error = repr(e)
+        # 会话对象仍然存活，此时的增量即该会话占用的内存
+        self.memory = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        self.at = None
+        return self
+
+
+_stub = None
+
+
+def _init_worker(stub_kwargs):
+    global _stub
+    _stub = RecordingStub(**stub_kwargs)
+    llm_provider.set_provider(_stub)
+
+
+def _run_patient(patient_args):
+    patient = Patient(*patient_args).run()
+    streams, _stub.streams = _stub.streams, []
+    chat = [s for task, s in streams if task == llm_provider.TASK_CHAT]
+    return {
+        "turns": patient.turns,
+        "reruns": patient.reruns,
+        "memory": patient.memory,
+        "error": patient.error,
+        "ttfts": [s.ttft for s in chat if s.ttft is not None],
+        "chat_calls": len(chat),
+        "smart_reply_calls": sum(1 for task, _ in streams if task == llm_provider.TASK_SMART_REPLY),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="并发问诊压测（本地桩，无需 API Key）")
+    parser.add_argument("--sessions", type=int, default=10, help="模拟患者总数")
+    parser.add_argument("--concurrency", type=int, default=5, help="同时进行的会话数")
+    parser.add_argument("--turns", type=int, default=4, help="每位患者回答的问题数")
+    parser.add_argument("--follow-ups", type=int, default=2, help="报告后的追问次数")
+    parser.add_argument("--ttft", type=float, default=0.3, help="本地桩首 token 延迟（秒）")
+    parser.add_argument("--tps", type=float, default=60.0, help="本地桩每秒输出 token 数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="本地桩请求失败概率")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120.0, help="单次页面运行超时（秒）")
+    parser.add_argument("--json", help="同时把结果写入该 JSON 文件")
+    args = parser.parse_args()
+
+    stub_kwargs = {"ttft": args.ttft, "tokens_per_sec": args.tps, "error_rate": args.error_rate, "seed": args.seed}
+    rng = random.Random(args.seed)
+    jobs = [(rng.random(), args.turns, args.follow_ups, args.timeout) for _ in range(args.sessions)]
+    started = time.perf_counter()
+    # AppTest 运行时会替换 __main__，工作函数须按模块名引用才能在子进程中反序列化
+    import load_test as worker
+    # 用 spawn 启动干净的工作进程，避免 fork 继承父进程中的线程与锁
+    with multiprocessing.get_context("spawn").Pool(args.concurrency, initializer=worker._init_worker, initargs=(stub_kwargs,)) as pool:
+        results = pool.map(worker._run_patient, jobs, chunksize=1)
+    elapsed = time.perf_counter() - started
+
+    turns = [t for r in results for t in r["turns"]]
+    reruns = [t for r in results for t in r["reruns"]]
+    ttfts = [t for r in results for t in r["ttfts"]]
+    errors = [r["error"] for r in results if r["error"]]
+    result = {
+        "sessions": args.sessions,
+        "concurrency": args.concurrency,
+        "wall_time_s": elapsed,
+        "errors": len(errors),
+        "chat_calls": sum(r["chat_calls"] for r in results),
+        "smart_reply_calls": sum(r["smart_reply_calls"] for r in results),
+        "ttft_p50_s": percentile(ttfts, 50),
+        "ttft_p95_s": percentile(ttfts, 95),
+        "rerun_mean_s": statistics.fmean(reruns) if reruns else float("nan"),
+        "rerun_p95_s": percentile(reruns, 95),
+        "turn_p50_s": percentile(turns, 50),
+        "turn_p95_s": percentile(turns, 95),
+        "turn_p99_s": percentile(turns, 99),
+        "memory_per_session_kb": statistics.fmean(r["memory"] for r in results) / 1024,
+    }
+    width = max(len(k) for k in result)
+    for key, value in result.items():
+        print(f"{key:<{width}}  {value:.3f}" if isinstance(value, float) else f"{key:<{width}}  {value}")
+    for error in errors[:5]:
+        print("error:", error)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
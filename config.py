@@ -0,0 +1,132 @@
+# ================= 运行参数 =================
+# 可通过环境变量覆盖，便于在不同部署环境下调优，无需改代码。
+import os
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_map(name, default, cast=str):
+    """解析“键=值,键=值”形式的环境变量；格式不对的项忽略，缺省项取默认值"""
+    result = {}
+    for raw in (default, os.environ.get(name, "")):
+        for item in raw.split(","):
+            key, sep, value = item.partition("=")
+            if not sep or not key.strip():
+                continue
+            try:
+                result[key.strip()] = cast(value.strip())
+            except ValueError:
+                pass
+    return result
+
+
+# 流式输出：两次刷新页面之间的最短间隔（秒）
+STREAM_FLUSH_INTERVAL = _env_float("ZY_STREAM_FLUSH_INTERVAL", 0.1)
+# 流式输出：缓冲超过该字节数时立即刷新，不等时间间隔
+STREAM_FLUSH_BYTES = _env_int("ZY_STREAM_FLUSH_BYTES", 512)
+
+# 上游连接池：全进程共用一个 HTTP 客户端，复用长连接
+HTTP_MAX_CONNECTIONS = _env_int("ZY_HTTP_MAX_CONNECTIONS", 32)
+HTTP_MAX_KEEPALIVE = _env_int("ZY_HTTP_MAX_KEEPALIVE", 16)
+HTTP_KEEPALIVE_EXPIRY = _env_float("ZY_HTTP_KEEPALIVE_EXPIRY", 60.0)
+HTTP_TIMEOUT = _env_float("ZY_HTTP_TIMEOUT", 120.0)
+
+# 上游限流：同时进行的请求数上限 + 令牌桶（每秒请求数 / 突发容量）
+LLM_MAX_CONCURRENCY = _env_int("ZY_LLM_MAX_CONCURRENCY", 8)
+LLM_RATE_PER_SEC = _env_float("ZY_LLM_RATE_PER_SEC", 5.0)
+LLM_BURST = _env_int("ZY_LLM_BURST", 10)
+
+# 模型路由：各档位对应的模型、各任务所用档位（简短的回答选项和锦囊走快速档）
+MODEL_TIERS = _env_map("ZY_MODEL_TIERS", "main=glm-4,fast=glm-4-flash")
+TASK_TIERS = _env_map("ZY_TASK_TIERS", "chat=main,report_section=main,smart_reply=fast,health_tip=fast")
+# 模型路由：各任务等待首 token 的时限（秒），超时即放弃本次请求并重试
+TASK_TTFT_BUDGETS = _env_map(
+    "ZY_TASK_TTFT_BUDGETS", "chat=15,report_section=20,smart_reply=4,health_tip=8", float
+)
+# 对冲请求：首 token 等待超过近期该分位数（且不少于最短时间）时再发一份相同请求，取先返回者；
+# 样本不足时按时限的一半；分位数设为 0 关闭对冲
+HEDGE_PERCENTILE = _env_float("ZY_HEDGE_PERCENTILE", 95.0)
+HEDGE_MIN_SAMPLES = _env_int("ZY_HEDGE_MIN_SAMPLES", 20)
+HEDGE_MIN_DELAY = _env_float("ZY_HEDGE_MIN_DELAY", 1.0)
+# 重试：首 token 之前失败时最多重试的次数、指数退避的基数（秒，另加随机抖动）
+LLM_RETRIES = _env_int("ZY_LLM_RETRIES", 2)
+LLM_RETRY_BACKOFF = _env_float("ZY_LLM_RETRY_BACKOFF", 0.5)
+# 熔断：同一模型连续失败达到次数后暂停调用若干秒，期间直接走本地兜底
+BREAKER_FAILURES = _env_int("ZY_BREAKER_FAILURES", 5)
+BREAKER_COOLDOWN = _env_float("ZY_BREAKER_COOLDOWN", 30.0)
+
+# 上下文压缩：每次请求的 token 预算（含系统提示词），超出时把较早的问答压缩为症状摘要
+CONTEXT_TOKEN_BUDGET = _env_int("ZY_CONTEXT_TOKEN_BUDGET", 4000)
+# 上下文压缩：无论预算如何，最近的这几条消息始终原样保留
+CONTEXT_KEEP_RECENT = _env_int("ZY_CONTEXT_KEEP_RECENT", 4)
+
+# 回复缓存：内存 LRU 条数、磁盘 SQLite 文件位置及容量上限（字节）
+CACHE_MEMORY_ITEMS = _env_int("ZY_CACHE_MEMORY_ITEMS", 256)
+CACHE_DB_PATH = os.environ.get("ZY_CACHE_DB_PATH", ".cache/responses.sqlite3")
+CACHE_MAX_BYTES = _env_int("ZY_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+
+# 诊断报告分板块并行生成（设为 0 则退回整份报告一次生成）、板块生成线程数
+REPORT_PARALLEL = os.environ.get("ZY_REPORT_PARALLEL", "1") == "1"
+REPORT_WORKERS = _env_int("ZY_REPORT_WORKERS", 16)
+
+# 本地中医知识库：资料目录（随项目分发）、索引文件位置（首次使用时自动构建）、每类资料注入提示词的条数
+KNOWLEDGE_DIR = os.environ.get("ZY_KNOWLEDGE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge"))
+KNOWLEDGE_INDEX_PATH = os.environ.get("ZY_KNOWLEDGE_INDEX_PATH", ".cache/knowledge.idx")
+KNOWLEDGE_TOP_K = _env_int("ZY_KNOWLEDGE_TOP_K", 3)
+
+# 问诊会话存储：SQLite 文件位置、内存中最多保留的会话数、闲置多少秒后换出到磁盘
+SESSION_DB_PATH = os.environ.get("ZY_SESSION_DB_PATH", ".cache/sessions.sqlite3")
+SESSION_MEMORY_ITEMS = _env_int("ZY_SESSION_MEMORY_ITEMS", 200)
+SESSION_IDLE_SECONDS = _env_float("ZY_SESSION_IDLE_SECONDS", 600.0)
+
+# 后台回复生成：读取上游流的线程数（超出 LLM_MAX_CONCURRENCY 的部分决定可同时进行的分板块报告数）、
+# 生成结束后缓冲区保留的秒数、页面读取缓冲区的间隔（秒）
+GENERATION_THREADS = _env_int("ZY_GENERATION_THREADS", 64)
+GENERATION_KEEP_SECONDS = _env_float("ZY_GENERATION_KEEP_SECONDS", 120.0)
+GENERATION_POLL_INTERVAL = _env_float("ZY_GENERATION_POLL_INTERVAL", 0.25)
+
+# 大模型后端：zhipu（智谱 API）或 stub（本地脚本化桩，离线压测 / 回归用）
+LLM_PROVIDER = os.environ.get("ZY_LLM_PROVIDER", "zhipu")
+# 本地桩：首 token 延迟（秒）、每秒输出 token 数、请求失败概率
+STUB_TTFT = _env_float("ZY_STUB_TTFT", 0.3)
+STUB_TOKENS_PER_SEC = _env_float("ZY_STUB_TOKENS_PER_SEC", 40.0)
+STUB_ERROR_RATE = _env_float("ZY_STUB_ERROR_RATE", 0.0)
+
+# 照片识别（舌诊、面诊、拍报告、拍药盒）：识别后端（zhipu / stub，默认与大模型后端一致）、视觉模型、
+# 本地桩的识别耗时（秒）、后台处理线程数
+VISION_PROVIDER = os.environ.get("ZY_VISION_PROVIDER", LLM_PROVIDER)
+VISION_MODEL = os.environ.get("ZY_VISION_MODEL", "glm-4v")
+VISION_STUB_LATENCY = _env_float("ZY_VISION_STUB_LATENCY", 0.8)
+IMAGE_WORKERS = _env_int("ZY_IMAGE_WORKERS", 4)
+# 上传照片的大小上限（字节）与像素上限、缩小后的最长边（像素）、重新编码的 JPEG 质量
+IMAGE_MAX_UPLOAD_BYTES = _env_int("ZY_IMAGE_MAX_UPLOAD_BYTES", 20 * 1024 * 1024)
+IMAGE_MAX_PIXELS = _env_int("ZY_IMAGE_MAX_PIXELS", 50_000_000)
+IMAGE_MAX_SIDE = _env_int("ZY_IMAGE_MAX_SIDE", 1024)
+IMAGE_JPEG_QUALITY = _env_int("ZY_IMAGE_JPEG_QUALITY", 85)
+# 识别结果缓存：最多条目数；同一会话内视为同一张照片的最大汉明距离（感知哈希共 256 位）
+# 与颜色特征（4 x 4 格 RGB 均值）任一格的最大差值（0-255）
+IMAGE_CACHE_ITEMS = _env_int("ZY_IMAGE_CACHE_ITEMS", 1024)
+IMAGE_HASH_DISTANCE = _env_int("ZY_IMAGE_HASH_DISTANCE", 16)
+IMAGE_COLOUR_DISTANCE = _env_int("ZY_IMAGE_COLOUR_DISTANCE", 24)
+
+# 性能指标：JSONL 明细日志（按大小轮转）、Prometheus 文本格式指标文件，
+# METRICS_PORT 非 0 时另起 HTTP 服务暴露 /metrics
+METRICS_LOG_PATH = os.environ.get("ZY_METRICS_LOG_PATH", ".cache/metrics.jsonl")
+METRICS_LOG_MAX_BYTES = _env_int("ZY_METRICS_LOG_MAX_BYTES", 10 * 1024 * 1024)
+METRICS_LOG_BACKUPS = _env_int("ZY_METRICS_LOG_BACKUPS", 5)
+METRICS_PROM_PATH = os.environ.get("ZY_METRICS_PROM_PATH", ".cache/metrics.prom")
+METRICS_PORT = _env_int("ZY_METRICS_PORT", 0)
+# 侧边栏性能调试面板；也可在网址后加 ?debug=1 临时打开
+DEBUG_PANEL = os.environ.get("ZY_DEBUG_PANEL", "") == "1"
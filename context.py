@@ -0,0 +1,156 @@
+# ================= 对话上下文管理 =================
+# 每轮请求不再原样发送全部历史：按 token 预算从最近的消息往前保留，
+# 更早的问答压缩为结构化症状摘要；追问阶段把完整报告替换为精简版。
+import logging
+import re
+
+import config
+from prompts import CMD_GENERATE_REPORT, is_report
+
+logger = logging.getLogger("zhongyi.context")
+
+# 症状维度与归类关键词，顺序与系统提示词中的“寒热、汗液、二便、饮食、睡眠、情志、舌象”一致
+SYMPTOM_DIMENSIONS = {
+    "寒热": ("冷", "热", "寒", "凉", "温"),
+    "汗液": ("汗",),
+    "二便": ("便", "尿", "腹泻", "拉肚子"),
+    "饮食": ("饮食", "胃口", "食欲", "口味", "口干", "口苦", "口渴", "吃", "喝", "胀"),
+    "睡眠": ("睡", "梦", "失眠", "醒"),
+    "情志": ("情绪", "心情", "烦", "焦虑", "压力", "急躁", "抑郁", "生气"),
+    "舌象": ("舌",),
+}
+
+# 每条消息除正文外的格式开销
+_MESSAGE_OVERHEAD = 4
+_CJK_RE = re.compile(r"[　-〿一-鿿＀-￯]")
+_QUESTION_RE = re.compile(r"[^。！!？?\n]*[？?]")
+# 精简报告中每个板块保留的字数（深度辨证全文保留）
+_SECTION_PREVIEW = 60
+
+
+def count_tokens(text):
+    """估算 token 数：中文按每字 1 个，其余字符按每 4 个 1 个"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(message):
+    return count_tokens(message["content"]) + _MESSAGE_OVERHEAD
+
+
+def count_messages_tokens(messages):
+    return sum(count_message_tokens(m) for m in messages)
+
+
+def condense_report(report):
+    """精简报告：深度辨证全文保留，其余板块只留标题和开头"""
+    sections = re.split(r"\n(?=### )", report.strip())
+    condensed = []
+    for section in sections:
+        title, _, body = section.partition("\n")
+        if "深度辨证" in title:
+            condensed.append(section.strip())
+            continue
+        body = " ".join(line.strip() for line in body.splitlines() if line.strip())
+        if len(body) > _SECTION_PREVIEW:
+            body = body[:_SECTION_PREVIEW] + "…"
+        condensed.append(f"{title.strip()}\n{body}" if body else title.strip())
+    return "\n".join(condensed)
+
+
+def _last_question(text):
+    questions = _QUESTION_RE.findall(text)
+    return questions[-1].strip() if questions else text.strip()[-40:]
+
+
+def summarize_symptoms(messages):
+    """把较早的问答压缩为按维度归类的症状摘要"""
+    dims = {name: [] for name in SYMPTOM_DIMENSIONS}
+    chief, others, follow_ups, report = "", [], [], ""
+    question = ""
+    for message in messages:
+        content = message["content"]
+        if message["role"] == "assistant":
+            if is_report(content):
+                report = condense_report(content)
+                question = ""
+            else:
+                question = _last_question(content)
+            continue
+        if message["role"] != "user" or content == CMD_GENERATE_REPORT:
+            continue
+        if report:
+            follow_ups.append(content)
+        elif not chief:
+            chief = content
+        else:
+            matched = [name for name, words in SYMPTOM_DIMENSIONS.items()
+                       if any(w in question or w in content for w in words)]
+            item = f"{content}（问：{question}）" if question else content
+            for name in matched[:1] or ["其他"]:
+                (dims[name] if name in dims else others).append(item)
+        question = ""
+
+    lines = ["【已收集症状摘要】"]
+    if chief:
+        lines.append(f"- 主诉：{chief}")
+    for name, items in dims.items():
+        lines.append(f"- {name}：{'；'.join(items) if items else '未提及'}")
+    if others:
+        lines.append(f"- 其他：{'；'.join(others)}")
+    if report:
+        lines.append("【既往诊断报告摘要】")
+        lines.append(report)
+    if follow_ups:
+        lines.append(f"【用户已追问】{'；'.join(follow_ups)}")
+    return "\n".join(lines)
+
+
+def build_context(messages, budget=None, keep_recent=None):
+    """按 token 预算构造发送给大模型的消息列表，不修改原列表"""
+    budget = config.CONTEXT_TOKEN_BUDGET if budget is None else budget
+    keep_recent = config.CONTEXT_KEEP_RECENT if keep_recent is None else keep_recent
+    system, history = messages[0], list(messages[1:])
+
+    # 追问阶段：报告已不是最新消息时，用精简版代替完整报告
+    for i in range(len(history) - 2, -1, -1):
+        if history[i]["role"] == "assistant" and is_report(history[i]["content"]):
+            history[i] = {"role": "assistant", "content": condense_report(history[i]["content"])}
+            break
+
+    costs = [count_message_tokens(m) for m in history]
+    system_cost = count_message_tokens(system)
+    # 从最近的消息往前保留，超出预算的部分交给摘要
+    cut = 0
+    used = system_cost
+    for i in range(len(history) - 1, -1, -1):
+        if len(history) - i > keep_recent and used + costs[i] > budget:
+            cut = i + 1
+            break
+        used += costs[i]
+
+    summary = ""
+    while cut:
+        summary = summarize_symptoms(history[:cut])
+        total = system_cost + count_tokens(summary) + sum(costs[cut:])
+        if total <= budget or len(history) - cut <= keep_recent:
+            break
+        cut += 1
+    # 不要把回答和它对应的提问拆开：提问一并原样保留
+    if 0 < cut < len(history) and history[cut]["role"] == "user" and history[cut - 1]["role"] == "assistant":
+        cut -= 1
+        summary = summarize_symptoms(history[:cut]) if cut else ""
+
+    if summary:
+        system = {"role": "system", "content": system["content"] + "\n" + summary}
+    payload = [system] + history[cut:]
+
+    full_tokens = count_messages_tokens(messages)
+    sent_tokens = count_messages_tokens(payload)
+    logger.info(
+        "context tokens: full=%d sent=%d saved=%d messages=%d->%d",
+        full_tokens, sent_tokens, full_tokens - sent_tokens, len(messages), len(payload),
+    )
+    return payload
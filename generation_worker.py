@@ -0,0 +1,241 @@
+# ================= 后台回复生成 =================
+# 回复不再在页面脚本里边生成边渲染：全进程共用一个 asyncio 事件循环（独立线程）持有所有上游流，
+# 生成的内容按问诊会话写入缓冲区，页面只需定时读取并渲染。刷新页面或网络闪断后，
+# 新的页面会话按会话编号重新接上进行中或已完成的生成，不会重新请求；生成期间也不再占着页面脚本线程。
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+import config
+import llm_client
+from stage_detector import StageDetector
+
+logger = logging.getLogger("zhongyi.generation")
+
+_END = object()
+
+
+class GenerationCancelled(Exception):
+    """生成已被取消（用户开始新问诊或发送了新的回答）"""
+
+
+async def aiter_stream(stream):
+    """在线程中逐段取出同步的流式回复，不阻塞事件循环；结束或被取消时关闭上游"""
+    iterator = iter(stream)
+    try:
+        while True:
+            piece = await asyncio.to_thread(next, iterator, _END)
+            if piece is _END:
+                return
+            yield piece
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+
+
+class Generation:
+    """一次回复的生成状态与内容缓冲区，可被多个页面会话同时读取"""
+
+    def __init__(self, session_id, turn, detect_stage, on_event=None):
+        self.session_id = session_id
+        # 发起生成时问诊的消息条数，用于判断缓冲区属于哪一轮
+        self.turn = turn
+        self.detector = StageDetector() if detect_stage else None
+        self.options = None     # 流式途中为问句提前准备的回答选项（Future），由 on_event 回调设置
+        self.position = None    # 排队时前方的请求数
+        self.error = None       # 上游出错时的异常类型名（已由兜底内容补上时仍会记录）
+        self.failed = False     # 出错且没有兜底内容，本轮回复未生成
+        self.done = False
+        self.cancelled = False
+        self.usage = None
+        self.started_at = time.monotonic()
+        self.first_token_at = None
+        self.finished_at = None
+        self._pieces = []
+        self._lock = threading.Lock()
+        self._stream = None
+        self._future = None
+        self._on_event = on_event
+
+    @property
+    def text(self):
+        with self._lock:
+            return "".join(self._pieces)
+
+    @property
+    def report_started(self):
+        return self.detector is not None and self.detector.report
+
+    @property
+    def ttft(self):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def duration(self):
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def _append(self, piece):
+        if not piece:
+            return
+        with self._lock:
+            self._pieces.append(piece)
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        if self.detector is not None:
+            event = self.detector.feed(piece)
+            if event is not None and self._on_event is not None:
+                self._on_event(self, event)
+
+    def _waiting(self, position):
+        # 排队回调：记录位置供页面展示；已取消时抛出异常，放弃排队
+        if self.cancelled:
+            raise GenerationCancelled()
+        self.position = position
+
+    def cancel(self):
+        self.cancelled = True
+        stream = self._stream
+        if stream is not None:
+            stream.close()
+        if self._future is not None:
+            self._future.cancel()
+        # 这一轮作废，提前准备的回答选项也用不上了（已开始调用的无法中止，结果丢弃）
+        if self.options is not None:
+            self.options.cancel()
+
+
+class GenerationWorker:
+    """全进程共用的后台生成器：每个问诊会话同一时刻最多一个生成"""
+
+    def __init__(self, threads, keep_seconds):
+        self._keep_seconds = keep_seconds
+        self._generations = {}  # 会话编号 -> Generation
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        # 上游接口是同步的，逐段读取放到线程池里进行；线程只在等待下一段时占用
+        self._loop.set_default_executor(ThreadPoolExecutor(max_workers=threads, thread_name_prefix="generation"))
+        # 排队等上游名额单独用一个线程池，排队的生成再多也不会占满读取线程，
+        # 否则已拿到名额的流取不到线程读下一段、名额永不释放，整个进程卡死
+        self._admission = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="generation-admission")
+        # 自行排队的流（分板块报告）在读取线程里等名额，同时读取的数量要给持有名额的流留足线程
+        self._self_limited = asyncio.Semaphore(max(1, threads - config.LLM_MAX_CONCURRENCY))
+        threading.Thread(target=self._loop.run_forever, name="generation-loop", daemon=True).start()
+
+    # open_stream(on_wait) 返回流式回复；limit 为真时先占用一个上游名额；
+    # self_limited 为真表示流在读取时自行占用名额（如分板块报告），与 limit 不同时使用；
+    # fallback(异常, 已生成文本) 返回替补内容，返回 None 则本轮失败；
+    # on_event(generation, 事件) 在识别出问句或报告开头时于事件循环中调用，须立即返回；
+    # on_finish(generation) 在内容生成完毕后于后台线程调用，用于写回问诊记录
+    def submit(self, session_id, turn, open_stream, *, limit=True, self_limited=False, detect_stage=False,
+               fallback=None, on_event=None, on_finish=None):
+        """开始一次生成并返回 Generation；该会话之前的生成随之取消"""
+        generation = Generation(session_id, turn, detect_stage, on_event)
+        with self._lock:
+            self._purge()
+            previous = self._generations.get(session_id)
+            self._generations[session_id] = generation
+        if previous is not None and not previous.done:
+            previous.cancel()
+        generation._future = asyncio.run_coroutine_threadsafe(
+            self._run(generation, open_stream, limit, self_limited, fallback, on_finish), self._loop
+        )
+        return generation
+
+    def get(self, session_id):
+        """该会话最近一次的生成，没有或已过期时返回 None"""
+        with self._lock:
+            return self._generations.get(session_id)
+
+    def cancel(self, session_id):
+        """取消该会话进行中的生成"""
+        with self._lock:
+            generation = self._generations.pop(session_id, None)
+        if generation is not None and not generation.done:
+            generation.cancel()
+
+    def active_count(self):
+        with self._lock:
+            return sum(1 for g in self._generations.values() if not g.done)
+
+    def _purge(self):
+        now = time.monotonic()
+        for session_id, generation in list(self._generations.items()):
+            if generation.done and now - generation.finished_at > self._keep_seconds:
+                del self._generations[session_id]
+
+    async def _admit(self, generation):
+        """在排队线程池中占用一个上游名额，返回已进入的名额；排队期间被取消时，名额一到手即释放"""
+        slot = llm_client.limiter.slot(generation.session_id, on_wait=generation._waiting)
+        entered = self._loop.run_in_executor(self._admission, slot.__enter__)
+        try:
+            await asyncio.shield(entered)
+        except asyncio.CancelledError:
+            entered.add_done_callback(
+                lambda f: f.cancelled() or f.exception() is not None or slot.__exit__(None, None, None)
+            )
+            raise
+        return slot
+
+    async def _run(self, generation, open_stream, limit, self_limited, fallback, on_finish):
+        try:
+            with ExitStack() as stack:
+                if limit:
+                    stack.push(await self._admit(generation))
+                elif self_limited:
+                    await self._self_limited.acquire()
+                    stack.callback(self._self_limited.release)
+                generation.position = None
+                try:
+                    stream = open_stream(generation._waiting)
+                    generation._stream = stream
+                    if generation.cancelled:
+                        stream.close()
+                        return
+                    async for piece in aiter_stream(stream):
+                        generation._append(piece)
+                    generation.usage = getattr(stream, "usage", None)
+                except Exception as e:
+                    if generation.cancelled:
+                        return
+                    generation.error = type(e).__name__
+                    replacement = fallback(e, generation.text) if fallback is not None else None
+                    if replacement is None:
+                        raise
+                    logger.warning("generation for %s failed, using fallback: %r", generation.session_id, e)
+                    for piece in replacement:
+                        generation._append(piece)
+            if on_finish is not None:
+                await asyncio.to_thread(on_finish, generation)
+        except GenerationCancelled:
+            logger.info("generation for %s cancelled while queued", generation.session_id)
+        except asyncio.CancelledError:
+            logger.info("generation for %s cancelled", generation.session_id)
+            raise
+        except Exception as e:
+            logger.exception("generation for %s failed", generation.session_id)
+            generation.error = generation.error or type(e).__name__
+            generation.failed = True
+        finally:
+            generation.finished_at = time.monotonic()
+            generation.done = True
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_worker():
+    """本进程共用的后台生成器"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = GenerationWorker(config.GENERATION_THREADS, config.GENERATION_KEEP_SECONDS)
+        return _worker
@@ -0,0 +1,226 @@
+# ================= 照片上传处理 =================
+# 上传的照片不直接送去识别：先在后台线程里按最长边缩小、重新编码为 JPEG，
+# 并去掉 EXIF（拍摄地点、设备等隐私信息随之清除），送往上游的数据通常只有原图的几十分之一。
+# 识别结果按内容缓存：完全相同的文件（SHA-256 一致）各会话共用；同一会话内只是略有差异（重新压缩、轻微裁剪、调亮）
+# 的照片按差值感知哈希（dHash，只看明暗）加颜色特征匹配，舌色、面色不同的照片不会被当成同一张。
+# 整个处理在线程池中进行，页面脚本只负责提交和定时查看结果。
+import hashlib
+import io
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from PIL import Image, ImageOps
+
+import config
+import llm_client
+import llm_provider
+import metrics
+import vision
+
+logger = logging.getLogger("zhongyi.images")
+
+# dHash 的边长：16 x 16 = 256 位，比常见的 64 位更不容易把不同的照片当成同一张
+_HASH_SIZE = 16
+# 颜色特征：缩成 4 x 4 后各格的 RGB 均值
+_COLOUR_GRID = 4
+
+
+class ImageError(ValueError):
+    """上传的文件不是可处理的照片（格式不支持、损坏或过大）"""
+
+
+@dataclass
+class PreparedImage:
+    """预处理后的照片"""
+    data: bytes          # 重新编码后的 JPEG，不含 EXIF
+    width: int
+    height: int
+    phash: int           # 感知哈希
+    colour: bytes        # 颜色特征
+    digest: str          # 原始上传内容的 SHA-256
+    upload_bytes: int    # 原始上传大小
+    seconds: float       # 预处理耗时
+
+
+@dataclass
+class ImageResult:
+    """一张照片的识别结果及处理指标"""
+    kind: str
+    findings: dict
+    text: str            # 写入问诊对话的紧凑文字
+    cache_hit: bool
+    upload_bytes: int
+    prepared_bytes: int
+    preprocess_seconds: float
+    analyze_seconds: float
+
+
+def dhash(image):
+    """差值感知哈希：缩成灰度小图后比较相邻像素的明暗"""
+    small = image.convert("L").resize((_HASH_SIZE + 1, _HASH_SIZE), Image.BILINEAR)
+    pixels = small.tobytes()
+    width = _HASH_SIZE + 1
+    value = 0
+    for row in range(_HASH_SIZE):
+        offset = row * width
+        for col in range(_HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def colour_signature(image):
+    """颜色特征：缩成 4 x 4 小图后各格的 RGB 均值，共 48 字节"""
+    return image.convert("RGB").resize((_COLOUR_GRID, _COLOUR_GRID), Image.BOX).tobytes()
+
+
+def colour_distance(a, b):
+    """两组颜色特征的差值（0-255）：取各格 RGB 平均差值中最大的一格，局部颜色变化（如舌色）不会被整体平均掉"""
+    return max(sum(abs(a[i + c] - b[i + c]) for c in range(3)) / 3 for i in range(0, len(a), 3))
+
+
+def preprocess(data, max_side=None, quality=None):
+    """缩小到最长边不超过 max_side、按 quality 重新编码为 JPEG，去掉 EXIF 并计算感知哈希"""
+    max_side = config.IMAGE_MAX_SIDE if max_side is None else max_side
+    quality = config.IMAGE_JPEG_QUALITY if quality is None else quality
+    started = time.perf_counter()
+    if len(data) > config.IMAGE_MAX_UPLOAD_BYTES:
+        raise ImageError(f"image too large: {len(data)} bytes")
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.width * image.height > config.IMAGE_MAX_PIXELS:
+                raise ImageError(f"image too large: {image.width}x{image.height}")
+            # JPEG 可直接按缩小的比例解码，省去解码整张大图
+            image.draft("RGB", (max_side, max_side))
+            # 按 EXIF 中的拍摄方向转正，之后 EXIF 不再保留
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+    except ImageError:
+        raise
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageError(f"unreadable image: {e}") from e
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=quality, optimize=True)
+    return PreparedImage(
+        data=out.getvalue(),
+        width=image.width,
+        height=image.height,
+        phash=dhash(image),
+        colour=colour_signature(image),
+        digest=hashlib.sha256(data).hexdigest(),
+        upload_bytes=len(data),
+        seconds=time.perf_counter() - started,
+    )
+
+
+class PerceptualCache:
+    """识别结果缓存，LRU 淘汰：
+    内容完全相同的照片跨会话共用结果；近似照片只在同一会话内匹配，
+    感知哈希的汉明距离与颜色特征的差值都不超过阈值才视为同一张"""
+
+    def __init__(self, capacity, max_distance, max_colour_distance):
+        self._capacity = capacity
+        self._max_distance = max_distance
+        self._max_colour_distance = max_colour_distance
+        self._exact = OrderedDict()    # (照片类型, SHA-256) -> 识别结果
+        self._similar = OrderedDict()  # (会话, 照片类型, 感知哈希, 颜色特征) -> 识别结果
+        self._lock = threading.Lock()
+
+    def get(self, session_id, kind, prepared):
+        with self._lock:
+            key = (kind, prepared.digest)
+            if key in self._exact:
+                self._exact.move_to_end(key)
+                return self._exact[key]
+            best, best_distance = None, self._max_distance + 1
+            for key in self._similar:
+                if key[0] != session_id or key[1] != kind:
+                    continue
+                distance = hamming(key[2], prepared.phash)
+                if distance < best_distance and colour_distance(key[3], prepared.colour) <= self._max_colour_distance:
+                    best, best_distance = key, distance
+                    if distance == 0:
+                        break
+            if best is None:
+                return None
+            self._similar.move_to_end(best)
+            return self._similar[best]
+
+    def put(self, session_id, kind, prepared, findings):
+        with self._lock:
+            for items, key in ((self._exact, (kind, prepared.digest)),
+                               (self._similar, (session_id, kind, prepared.phash, prepared.colour))):
+                items[key] = findings
+                items.move_to_end(key)
+                while len(items) > self._capacity:
+                    items.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._exact)
+
+
+class ImagePipeline:
+    """照片处理流水线：预处理 -> 查识别缓存 -> 识别，全部在后台线程池中完成"""
+
+    def __init__(self, backend, workers, cache):
+        self._backend = backend
+        self._cache = cache
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+
+    def submit(self, session_id, kind, data):
+        """提交一张照片，返回 Future，结果为 ImageResult；照片不可用时抛出 ImageError"""
+        if kind not in vision.KINDS:
+            raise ValueError(f"unknown image kind: {kind}")
+        return self._executor.submit(self.process, session_id, kind, data)
+
+    def process(self, session_id, kind, data):
+        """同步处理一张照片（由线程池调用，压测脚本也可直接调用）"""
+        prepared = preprocess(data)
+        findings = self._cache.get(session_id, kind, prepared)
+        cache_hit = findings is not None
+        started = time.perf_counter()
+        if not cache_hit:
+            model = self._backend.model
+            # 识别请求与对话共用上游名额
+            with llm_client.limiter.slot(session_id), metrics.track_call(llm_provider.TASK_VISION, model, session_id):
+                findings = self._backend.analyze(kind, prepared.data)
+            self._cache.put(session_id, kind, prepared, findings)
+        result = ImageResult(
+            kind=kind,
+            findings=findings,
+            text=vision.format_findings(kind, findings),
+            cache_hit=cache_hit,
+            upload_bytes=prepared.upload_bytes,
+            prepared_bytes=len(prepared.data),
+            preprocess_seconds=prepared.seconds,
+            analyze_seconds=time.perf_counter() - started,
+        )
+        metrics.metrics.record_image(session_id, result)
+        logger.info("image %s: %d -> %d bytes (%dx%d), preprocess %.3fs, cache_hit=%s",
+                    kind, result.upload_bytes, result.prepared_bytes, prepared.width, prepared.height,
+                    result.preprocess_seconds, cache_hit)
+        return result
+
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline(api_key=None):
+    """本进程共用的照片处理流水线"""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = ImagePipeline(
+                vision.get_backend(api_key), config.IMAGE_WORKERS,
+                PerceptualCache(config.IMAGE_CACHE_ITEMS, config.IMAGE_HASH_DISTANCE, config.IMAGE_COLOUR_DISTANCE),
+            )
+        return _pipeline
@@ -0,0 +1,285 @@
+# ================= 本地中医知识库 =================
+# knowledge/ 下随项目分发经典原文、穴位、食疗方三类资料，按字 + 二字组建 BM25 倒排索引。
+# 索引首次使用时构建并写入一个紧凑的二进制文件，之后直接内存映射，毫秒级加载；
+# 资料内容变化（哈希不一致）时自动重建。检索结果注入报告提示词，接口不可用时也可作本地兜底。
+import bisect
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import unicodedata
+from array import array
+
+import config
+from prompts import CMD_GENERATE_REPORT
+
+logger = logging.getLogger("zhongyi.knowledge")
+
+# 资料类型 -> 文件名
+KINDS = {
+    "classic": "classics.jsonl",
+    "acupoint": "acupoints.jsonl",
+    "recipe": "recipes.jsonl",
+}
+_KIND_IDS = {kind: i for i, kind in enumerate(KINDS)}
+
+# 报告板块 -> 可参考的资料类型
+SECTION_KINDS = {
+    "### 📜 经典溯源": "classic",
+    "### 🍵 膳食良方": "recipe",
+    "### 🧘 导引按跷": "acupoint",
+}
+
+# 短回答需结合所答的问题才有检索意义
+_AFFIRMATIVE = {"是", "有", "对", "是的", "有的", "都有", "经常", "会"}
+_TEXT_RE = re.compile(r"[一-鿿A-Za-z0-9]+")
+# 禁忌中写明孕妇禁用/慎用的资料，caution_tags 必须带上孕期相关的词，否则孕妇检索时仍会被推荐
+_PREGNANCY_RE = re.compile(r"孕妇|孕期|怀孕|妊娠")
+
+# 索引文件格式：文件头之后依次为词项哈希、倒排表偏移、文档号、词频、文档长度、文档类型、文档偏移、文档原文
+_MAGIC = b"ZYKB0001"
+_HEADER = struct.Struct("<8s16sIIIf")
+_BM25_K1 = 1.5
+_BM25_B = 0.75
+
+
+def tokenize(text):
+    """单字 + 相邻二字，中文无需分词"""
+    tokens = []
+    for run in _TEXT_RE.findall(unicodedata.normalize("NFKC", text or "").lower()):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def _term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _doc_text(kind, doc):
+    """参与检索的字段"""
+    if kind == "classic":
+        return " ".join((doc["quote"], doc["explain"], doc["tags"]))
+    if kind == "acupoint":
+        return " ".join((doc["name"], doc["indications"], doc["tags"]))
+    # 食疗方只索引适宜人群；慎用人群单独存放，用于排除，不参与匹配
+    return " ".join((doc["name"], doc["effect"], doc["suitable"], doc["tags"]))
+
+
+def format_doc(kind, doc):
+    """按报告模板的格式输出一条资料"""
+    if kind == "classic":
+        return f"> “{doc['quote']}”——《{doc['source']}》\n*   **释义**：{doc['explain']}"
+    if kind == "acupoint":
+        return (f"【{doc['name']}】（{doc['indications']}）【位置】{doc['location']}（{doc['finding']}）"
+                f"【手法】{doc['method']}【禁忌提示】{doc['caution']}")
+    return (f"【{doc['name']}】【食材】{doc['ingredients']}【做法】{doc['steps']}"
+            f"【功效】{doc['effect']}【适配提示】{doc['suitable']}；{doc['caution']}；{doc['usage']}")
+
+
+def contraindicated(doc, query):
+    """检索词中出现了资料的慎用人群或症状（caution_tags）"""
+    text = unicodedata.normalize("NFKC", query or "").lower()
+    return any(tag in text for tag in doc.get("caution_tags", "").split())
+
+
+def _load_corpus(directory):
+    docs = []
+    digest = hashlib.sha256()
+    for kind, filename in KINDS.items():
+        with open(os.path.join(directory, filename), "rb") as f:
+            raw = f.read()
+        digest.update(raw)
+        for line in raw.decode("utf-8").splitlines():
+            if line.strip():
+                doc = json.loads(line)
+                if _PREGNANCY_RE.search(doc.get("caution", "")) and not _PREGNANCY_RE.search(doc.get("caution_tags", "")):
+                    raise ValueError(f"{filename}: {doc['id']} is contraindicated in pregnancy but has no matching caution_tags")
+                docs.append((kind, doc))
+    return docs, digest.hexdigest()[:16].encode("ascii")
+
+
+def _pad(buf):
+    buf.extend(b"\0" * (-len(buf) % 8))
+
+
+def build_index(directory, path):
+    """从资料目录构建索引文件（先写临时文件再替换，多进程同时构建也安全）"""
+    docs, corpus_hash = _load_corpus(directory)
+    postings = {}
+    doc_lens = array("I")
+    for doc_id, (kind, doc) in enumerate(docs):
+        tokens = tokenize(_doc_text(kind, doc))
+        doc_lens.append(len(tokens))
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, tf in counts.items():
+            postings.setdefault(_term_hash(token), []).append((doc_id, tf))
+
+    hashes = array("Q", sorted(postings))
+    offsets, post_docs, post_tfs = array("I", [0]), array("I"), array("H")
+    for h in hashes:
+        for doc_id, tf in postings[h]:
+            post_docs.append(doc_id)
+            post_tfs.append(min(tf, 0xFFFF))
+        offsets.append(len(post_docs))
+    kinds = array("B", (_KIND_IDS[kind] for kind, _ in docs))
+    blobs = [json.dumps(doc, ensure_ascii=False).encode("utf-8") for _, doc in docs]
+    doc_offsets = array("Q", [0])
+    for blob in blobs:
+        doc_offsets.append(doc_offsets[-1] + len(blob))
+    avgdl = sum(doc_lens) / len(docs) if docs else 0.0
+
+    buf = bytearray(_HEADER.pack(_MAGIC, corpus_hash, len(docs), len(hashes), len(post_docs), avgdl))
+    for part in (hashes, offsets, post_docs, post_tfs, doc_lens, kinds, doc_offsets):
+        _pad(buf)
+        buf.extend(part.tobytes())
+    _pad(buf)
+    buf.extend(b"".join(blobs))
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(buf)
+    os.replace(tmp, path)
+    logger.info("knowledge index built: docs=%d terms=%d bytes=%d", len(docs), len(hashes), len(buf))
+    return corpus_hash
+
+
+class KnowledgeIndex:
+    """内存映射的 BM25 索引，只读，可多线程共用"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.corpus_hash, self.n_docs, n_terms, n_postings, self._avgdl = _HEADER.unpack_from(self._mm)
+        if magic != _MAGIC:
+            raise ValueError(f"not a knowledge index: {path}")
+        view = memoryview(self._mm)
+        pos = _HEADER.size
+
+        def take(fmt, count):
+            nonlocal pos
+            pos += -pos % 8
+            size = struct.calcsize(fmt) * count
+            part = view[pos:pos + size].cast(fmt)
+            pos += size
+            return part
+
+        self._hashes = take("Q", n_terms)
+        self._offsets = take("I", n_terms + 1)
+        self._post_docs = take("I", n_postings)
+        self._post_tfs = take("H", n_postings)
+        self._doc_lens = take("I", self.n_docs)
+        self._kinds = take("B", self.n_docs)
+        self._doc_offsets = take("Q", self.n_docs + 1)
+        self._blob_start = pos + (-pos % 8)
+        self._kind_names = list(KINDS)
+
+    def search(self, query, kind=None, k=3, exclude=None):
+        """返回 [(得分, 类型, 资料字典)]，按得分从高到低；exclude(资料字典) 为真的资料跳过"""
+        kind_id = None if kind is None else _KIND_IDS[kind]
+        scores = {}
+        for token in set(tokenize(query)):
+            h = _term_hash(token)
+            i = bisect.bisect_left(self._hashes, h)
+            if i == len(self._hashes) or self._hashes[i] != h:
+                continue
+            start, end = self._offsets[i], self._offsets[i + 1]
+            idf = math.log(1 + (self.n_docs - (end - start) + 0.5) / (end - start + 0.5))
+            for j in range(start, end):
+                doc_id = self._post_docs[j]
+                if kind_id is not None and self._kinds[doc_id] != kind_id:
+                    continue
+                tf = self._post_tfs[j]
+                norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * self._doc_lens[doc_id] / self._avgdl)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (_BM25_K1 + 1) / (tf + norm)
+        results = []
+        for doc_id, score in sorted(scores.items(), key=lambda item: -item[1]):
+            doc = self.doc(doc_id)
+            if exclude is not None and exclude(doc):
+                continue
+            results.append((score, self._kind_names[self._kinds[doc_id]], doc))
+            if len(results) == k:
+                break
+        return results
+
+    def doc(self, doc_id):
+        start = self._blob_start + self._doc_offsets[doc_id]
+        end = self._blob_start + self._doc_offsets[doc_id + 1]
+        return json.loads(bytes(self._mm[start:end]).decode("utf-8"))
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """本进程共用的知识库索引；索引文件缺失或资料有变化时先重建"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _, corpus_hash = _load_corpus(config.KNOWLEDGE_DIR)
+            path = config.KNOWLEDGE_INDEX_PATH
+            index = None
+            if os.path.exists(path):
+                try:
+                    index = KnowledgeIndex(path)
+                except (ValueError, struct.error) as e:
+                    logger.warning("knowledge index unreadable, rebuilding: %s", e)
+            if index is None or index.corpus_hash != corpus_hash:
+                build_index(config.KNOWLEDGE_DIR, path)
+                index = KnowledgeIndex(path)
+            _index = index
+        return _index
+
+
+def symptom_query(messages):
+    """由用户的回答拼出检索词；“是”“有”这类短回答带上所答的问题"""
+    parts = []
+    question = ""
+    for message in messages:
+        content = message["content"]
+        if message["role"] == "assistant":
+            question = content[-60:]
+        elif message["role"] == "user" and content != CMD_GENERATE_REPORT:
+            parts.append(f"{question} {content}" if content.strip("。！!") in _AFFIRMATIVE else content)
+    return " ".join(parts)
+
+
+def search(query, kind, k=None):
+    """检索某类资料，返回资料字典列表；慎用人群与检索词相符的资料不返回"""
+    k = config.KNOWLEDGE_TOP_K if k is None else k
+    results = get_index().search(query, kind=kind, k=k, exclude=lambda doc: contraindicated(doc, query))
+    return [doc for _, _, doc in results]
+
+
+def references(query, kind, k=None):
+    """注入提示词的参考资料，没有命中时返回空字符串"""
+    docs = search(query, kind, k)
+    if not docs:
+        return ""
+    lines = "\n".join(f"- {format_doc(kind, doc)}" for doc in docs)
+    return f"可参考以下本地资料（引用经典原文、穴位位置、食疗用量时以资料为准，可按用户情况取舍）：\n{lines}"
+
+
+def offline_section(title, query, k=2):
+    """接口不可用时用本地资料拼出一个报告板块，无对应资料时返回 None"""
+    kind = SECTION_KINDS.get(title)
+    if kind is None:
+        return None
+    docs = search(query, kind, k)
+    if not docs:
+        return None
+    if kind == "classic":
+        body = "\n\n".join(format_doc(kind, doc) for doc in docs)
+    else:
+        body = "\n".join(f"{i}.  {format_doc(kind, doc)}" for i, doc in enumerate(docs, 1))
+    return f"{title}\n{body}\n"
@@ -0,0 +1,144 @@
+# ================= 大模型客户端与限流 =================
+# 客户端及其 HTTP 连接池每个进程只创建一次，所有会话共用；
+# 所有上游调用先经过限流器：令牌桶控制速率，信号量控制并发，
+# 排队请求按会话轮转放行，避免单个会话的突发请求挤占其他用户。
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import httpx
+from zhipuai import ZhipuAI
+
+import config
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key):
+    """返回本进程共用的 ZhipuAI 客户端（带长连接池）"""
+    with _clients_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=config.HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=config.HTTP_MAX_KEEPALIVE,
+                    keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=config.HTTP_TIMEOUT,
+            )
+            # 重试只由模型路由负责（退避、限流令牌、熔断），SDK 自带的重试关掉，免得叠加成多倍请求
+            client = ZhipuAI(api_key=api_key, http_client=http_client, max_retries=0)
+            _clients[api_key] = client
+        return client
+
+
+class UpstreamLimiter:
+    """令牌桶 + 并发信号量，按会话公平排队"""
+
+    def __init__(self, max_concurrency, rate, burst):
+        self._max_concurrency = max_concurrency
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._active = 0
+        # 会话 -> 该会话排队中的请求；字典顺序即轮转顺序
+        self._queues = OrderedDict()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def _head(self):
+        for queue in self._queues.values():
+            return queue[0]
+        return None
+
+    def _position(self, ticket):
+        """轮转顺序下排在该请求前面的请求数"""
+        ahead = 0
+        queues = list(self._queues.values())
+        depth = max(len(q) for q in queues)
+        for i in range(depth):
+            for queue in queues:
+                if i < len(queue):
+                    if queue[i] is ticket:
+                        return ahead
+                    ahead += 1
+        return ahead
+
+    def _remove(self, session_id, ticket):
+        queue = self._queues.get(session_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[session_id]
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, session_id, on_wait=None):
+        """占用一个上游请求名额；排队时每隔片刻回调 on_wait(前方请求数)"""
+        ticket = object()
+        with self._cond:
+            self._queues.setdefault(session_id, deque()).append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    self._refill()
+                    if self._head() is ticket and self._active < self._max_concurrency and self._tokens >= 1:
+                        self._tokens -= 1
+                        self._active += 1
+                        self._remove(session_id, ticket)
+                        # 放行后该会话排到队尾，下一个名额先给其他会话
+                        if session_id in self._queues:
+                            self._queues.move_to_end(session_id)
+                        break
+                    position = self._position(ticket)
+                    if self._tokens < 1:
+                        timeout = min(0.5, (1 - self._tokens) / self._rate)
+                    else:
+                        timeout = 0.5
+                    self._cond.wait(timeout)
+                if on_wait is not None:
+                    on_wait(position)
+        except BaseException:
+            with self._cond:
+                self._remove(session_id, ticket)
+            raise
+        try:
+            yield
+        finally:
+            self.release()
+
+    def try_acquire(self):
+        """不排队地占用一个名额：并发已满、令牌不足或已有请求在排队时返回 False；成功后须调用 release()"""
+        with self._cond:
+            self._refill()
+            if self._queues or self._active >= self._max_concurrency or self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self._active += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def take_token(self):
+        """只从令牌桶取一个令牌（已占有名额的请求再次发出时使用），令牌不足时等待"""
+        with self._cond:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                self._cond.wait((1 - self._tokens) / self._rate)
+
+
+limiter = UpstreamLimiter(config.LLM_MAX_CONCURRENCY, config.LLM_RATE_PER_SEC, config.LLM_BURST)
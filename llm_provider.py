@@ -0,0 +1,241 @@
+# ================= 大模型后端 =================
+# 三处调用（问诊对话、回答选项、养生锦囊）统一经由 LLMProvider，
+# 可在智谱 API 与本地脚本化桩之间切换，便于无 Key 时压测和回归。
+import random
+import re
+import threading
+import time
+
+import config
+import llm_client
+from prompts import CMD_GENERATE_REPORT, is_report
+
+# 任务类型：问诊对话 / 诊断报告的单个板块 / 回答选项 / 养生锦囊 / 照片识别
+TASK_CHAT = "chat"
+TASK_REPORT_SECTION = "report_section"
+TASK_SMART_REPLY = "smart_reply"
+TASK_HEALTH_TIP = "health_tip"
+TASK_VISION = "vision"
+
+
+class ChatStream:
+    """流式回复：迭代得到文本片段；结束后 usage 为 token 用量"""
+
+    def __init__(self):
+        self.usage = None
+        self.started_at = time.monotonic()
+        self.first_token_at = None
+        self.finished_at = None
+
+    def _pieces(self):
+        raise NotImplementedError
+
+    def __iter__(self):
+        try:
+            for piece in self._pieces():
+                if piece:
+                    if self.first_token_at is None:
+                        self.first_token_at = time.monotonic()
+                    yield piece
+        finally:
+            self.finished_at = time.monotonic()
+
+    @property
+    def ttft(self):
+        """首 token 延迟（秒），尚未收到任何内容时为 None"""
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    def close(self):
+        """提前结束，释放上游连接"""
+
+
+class LLMProvider:
+    """大模型后端接口"""
+
+    def stream(self, messages, *, task, model, temperature):
+        """流式生成，返回 ChatStream"""
+        raise NotImplementedError
+
+    def complete(self, messages, *, task, model, temperature):
+        """一次性生成，返回完整文本"""
+        return "".join(self.stream(messages, task=task, model=model, temperature=temperature))
+
+
+class _ZhipuStream(ChatStream):
+    def __init__(self, response):
+        super().__init__()
+        self._response = response
+
+    def _pieces(self):
+        for chunk in self._response:
+            if getattr(chunk, "usage", None):
+                self.usage = chunk.usage
+            if chunk.choices:
+                yield chunk.choices[0].delta.content
+
+    def close(self):
+        http_response = getattr(self._response, "response", None)
+        if http_response is not None:
+            http_response.close()
+
+
+class ZhipuProvider(LLMProvider):
+    """智谱 API"""
+
+    def __init__(self, api_key):
+        self._client = llm_client.get_client(api_key)
+
+    def stream(self, messages, *, task, model, temperature):
+        response = self._client.chat.completions.create(
+            model=model, messages=messages, stream=True, temperature=temperature
+        )
+        return _ZhipuStream(response)
+
+    def complete(self, messages, *, task, model, temperature):
+        response = self._client.chat.completions.create(
+            model=model, messages=messages, temperature=temperature
+        )
+        return response.choices[0].message.content
+
+
+class StubError(RuntimeError):
+    """本地桩按设定概率模拟的上游错误"""
+
+
+# 本地桩的问诊脚本：依次提问，问完后输出报告；问法覆盖“是否”、选择题和开放式问题
+STUB_QUESTIONS = [
+    "明白了，这种情况确实让人困扰。请问您平时是怕冷还是怕热？",
+    "好的。请问您是否容易出汗，尤其是夜间睡着后出汗？",
+    "了解。您的大便是干燥、稀溏还是正常呢？",
+    "您能描述一下最近的胃口和口味偏好吗？",
+    "您有没有口干或者口苦的情况？",
+    "您最近的情绪怎么样，是否容易烦躁？",
+    "最后请您看一下舌头，舌苔是偏白还是偏黄？",
+]
+
+STUB_REPORT = """### 🩺 深度辨证
+综合您所述的入睡困难、怕冷、夜间出汗与大便稀溏等表现，病机在于脾肾阳气不足，卫外不固，心神失养。阳气虚则温煦无力，故畏寒肢冷；脾阳不振，运化失司，故大便溏薄、胃口欠佳；阳不入阴，则夜寐不安。综合辨为**阳虚质（脾肾阳虚）**。
+
+### 📜 经典溯源
+> “阳气者，若天与日，失其所则折寿而不彰。”——《黄帝内经·素问·生气通天论》
+*   **释义**：阳气对人体就像太阳对大地，阳气不足则全身失于温养，您的怕冷、便溏、睡眠不安都与此相关。
+
+### 🍵 膳食良方
+1.  【山药小米粥】【食材】山药100克、小米50克、红枣5枚【做法】山药去皮切块；小米淘净与红枣同煮；水开后加山药小火煮30分钟【功效】健脾益气，温中止泻【适配提示】脾胃虚寒者优先，糖尿病患者慎食，每日早餐1次，连食7天。
+2.  【当归生姜羊肉汤】【食材】羊肉250克、生姜15克、当归10克【做法】羊肉焯水；与姜片、当归同炖；小火炖1.5小时调味【功效】温阳散寒，养血通脉【适配提示】畏寒肢冷者优先，阴虚火旺及孕妇慎用，每周2次。
+
+### 🧘 导引按跷
+1.  【关元】（怕冷、便溏）【位置】肚脐正下方四横指处【手法】掌心按揉，每次3分钟，每日2次，以温热感为宜【禁忌提示】孕妇禁用。
+2.  【足三里】（胃口差、乏力）【位置】膝盖外侧凹陷下四横指，胫骨外一横指【手法】拇指按揉，每次3分钟，每日早晚各1次，以酸胀为度【禁忌提示】皮肤破损者禁用。
+
+### 🌞 起居禁忌
+1.  作息建议：22:30前入睡，养护阳气；晨起后晒背15分钟，借天阳补人阳；睡前温水泡脚20分钟，引阳入阴。
+2.  忌口清单：冰饮冷食（耗伤脾阳，替代：温开水、姜枣茶）；生冷瓜果（替代：蒸苹果、煮梨）；油腻厚味（碍脾运化，替代：清淡蒸煮菜肴）。
+
+### 😊 情志调理
+1.  思虑伤脾，睡前避免反复琢磨白天的事，可每日静坐10分钟，意守丹田，缓慢深呼吸。
+
+### ⚠️ 调理须知
+1.  本报告仅为养生调理参考，不构成专业医疗诊断、治疗建议，不可替代中医师面诊及医嘱。
+2.  若症状持续超过1周或加重，请及时前往正规医院中医科就诊。
+3.  所有调理方案需坚持1-2周方可显现效果，因人而异，请勿急于求成。
+"""
+
+STUB_FOLLOW_UP = "结合您的阳虚体质，建议以温补脾肾为主：日常饮食宜温热熟软，少食生冷；可适量食用山药、小米、红枣、生姜等温养之品，并坚持按揉关元、足三里。"
+
+STUB_TIPS = [
+    "🍵 午后一杯陈皮茶，理气健脾助消化。",
+    "🌙 亥时（21-23点）放下手机，静心养神入眠。",
+    "🚶 饭后缓行百步，助脾胃运化。",
+    "🌸 春季多伸展，舒畅肝气少动怒。",
+    "👣 每晚按揉涌泉穴3分钟，引火归元。",
+]
+
+
+class _StubStream(ChatStream):
+    def __init__(self, text, ttft, tokens_per_sec):
+        super().__init__()
+        self._text = text
+        self._ttft = ttft
+        self._interval = 1.0 / tokens_per_sec if tokens_per_sec > 0 else 0.0
+        self._closed = False
+
+    def _pieces(self):
+        time.sleep(self._ttft)
+        # 以 2 个字符近似 1 个 token
+        for i in range(0, len(self._text), 2):
+            if self._closed:
+                return
+            yield self._text[i:i + 2]
+            if self._interval:
+                time.sleep(self._interval)
+        self.usage = {"completion_tokens": (len(self._text) + 1) // 2}
+
+    def close(self):
+        self._closed = True
+
+
+class StubProvider(LLMProvider):
+    """本地脚本化桩：按设定的首 token 延迟、输出速度和错误率流式返回固定内容"""
+
+    def __init__(self, ttft=None, tokens_per_sec=None, error_rate=None, seed=None):
+        self.ttft = config.STUB_TTFT if ttft is None else ttft
+        self.tokens_per_sec = config.STUB_TOKENS_PER_SEC if tokens_per_sec is None else tokens_per_sec
+        self.error_rate = config.STUB_ERROR_RATE if error_rate is None else error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _script(self, messages, task):
+        if task == TASK_HEALTH_TIP:
+            with self._lock:
+                return self._random.choice(STUB_TIPS)
+        if task == TASK_SMART_REPLY:
+            return "偏白|偏黄|不清楚"
+        if task == TASK_REPORT_SECTION:
+            # 分板块请求：从完整报告中截取请求的那一段
+            title = re.search(r"「(### [^」]+)」", messages[-1]["content"]).group(1)
+            for section in re.split(r"\n(?=### )", STUB_REPORT.strip()):
+                if section.startswith(title):
+                    return section
+            return title
+        user_turns = [m for m in messages if m["role"] == "user"]
+        last = messages[-1]["content"]
+        # 上下文被压缩后用户轮数会变少，此时可能重复提问，不影响压测
+        if any(is_report(m["content"]) for m in messages if m["role"] == "assistant"):
+            return STUB_FOLLOW_UP
+        if CMD_GENERATE_REPORT in last or len(user_turns) > len(STUB_QUESTIONS):
+            return STUB_REPORT
+        return STUB_QUESTIONS[len(user_turns) - 1]
+
+    def stream(self, messages, *, task, model, temperature):
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+        if failed:
+            time.sleep(self.ttft)
+            raise StubError("stub provider: simulated upstream error")
+        return _StubStream(self._script(messages, task), self.ttft, self.tokens_per_sec)
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_provider(api_key=None):
+    """本进程共用的大模型后端，由 ZY_LLM_PROVIDER 选择"""
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            if config.LLM_PROVIDER == "stub":
+                _provider = StubProvider()
+            else:
+                _provider = ZhipuProvider(api_key)
+        return _provider
+
+
+def set_provider(provider):
+    """替换本进程共用的大模型后端（压测脚本注入本地桩时使用）"""
+    global _provider
+    with _provider_lock:
+        _provider = provider
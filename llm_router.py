@@ -0,0 +1,321 @@
+# ================= 模型路由 =================
+# 按任务选择模型档位（问诊、报告用主力模型，回答选项、锦囊用快速模型），并为每个任务设定首 token 时限：
+# 首 token 迟迟不来时加发一份对冲请求，取先返回者；首 token 之前失败按指数退避加随机抖动重试；
+# 同一模型连续失败则熔断，冷却期内直接报错，由调用方改用本地兜底（知识库报告、规则选项、备用锦囊）。
+# 路由表可用环境变量调整，每次决策都写入日志和性能指标。
+import logging
+import queue
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+
+import config
+import llm_client
+import llm_provider
+import metrics
+from llm_provider import ChatStream, LLMProvider
+
+logger = logging.getLogger("zhongyi.router")
+
+# 统计对冲分位数时每个路由保留的最近首 token 延迟数
+_TTFT_HISTORY = 200
+# 未在路由表中配置的任务使用的档位与时限
+_DEFAULT_TIER = "main"
+_DEFAULT_TTFT_BUDGET = 15.0
+
+
+class CircuitOpenError(RuntimeError):
+    """模型处于熔断冷却期，本次调用未发出"""
+
+
+class FirstTokenTimeout(TimeoutError):
+    """超过时限仍未收到首 token"""
+
+
+@dataclass(frozen=True)
+class Route:
+    """一个任务的路由：模型档位、模型名、首 token 时限（秒）"""
+    task: str
+    tier: str
+    model: str
+    ttft_budget: float
+
+
+def route_for(task):
+    """按配置查出任务的路由"""
+    tier = config.TASK_TIERS.get(task, _DEFAULT_TIER)
+    model = config.MODEL_TIERS.get(tier) or config.MODEL_TIERS.get(_DEFAULT_TIER, "glm-4")
+    return Route(task, tier, model, config.TASK_TTFT_BUDGETS.get(task, _DEFAULT_TTFT_BUDGET))
+
+
+def model_for(task):
+    """任务使用的模型名（调用方据此发起请求、记录指标和计算缓存键）"""
+    return route_for(task).model
+
+
+class CircuitBreaker:
+    """连续失败计数熔断：打开后冷却期内拒绝调用，冷却结束放行一次试探，成功即恢复"""
+
+    def __init__(self, model, failures, cooldown):
+        self._model = model
+        self._threshold = failures
+        self._cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self._cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            recovered = self._opened_at is not None
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+        if recovered:
+            logger.info("circuit closed: model=%s", self._model)
+
+    def failure(self):
+        """记录一次失败，返回本次是否打开了熔断"""
+        with self._lock:
+            self._failures += 1
+            reopened = self._probing
+            self._probing = False
+            if reopened or (self._opened_at is None and self._failures >= self._threshold):
+                self._opened_at = time.monotonic()
+                opened = True
+            else:
+                opened = False
+        if opened:
+            logger.warning("circuit open: model=%s failures=%d cooldown=%.1fs", self._model, self._failures, self._cooldown)
+        return opened
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+
+class _Attempt:
+    """一次上游请求：在后台线程里发出并等到首个片段"""
+
+    def __init__(self, provider, messages, route, temperature):
+        self._provider = provider
+        self._messages = messages
+        self._route = route
+        self._temperature = temperature
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self.stream = None
+        self.pieces = None
+        self.ttft = None
+
+    def start(self, results):
+        threading.Thread(target=self._run, args=(results,), name="llm-attempt", daemon=True).start()
+
+    def _run(self, results):
+        started = time.monotonic()
+        try:
+            stream = self._provider.stream(
+                self._messages, task=self._route.task, model=self._route.model, temperature=self._temperature
+            )
+            with self._lock:
+                self.stream = stream
+                cancelled = self._cancelled
+            if cancelled:
+                stream.close()
+                return
+            self.pieces = iter(stream)
+            first = next(self.pieces, "")
+        except Exception as e:
+            results.put((self, None, e))
+            return
+        self.ttft = time.monotonic() - started
+        results.put((self, first, None))
+
+    def cancel(self):
+        """放弃这次请求（对冲中落败或整体超时），已建立的上游连接随即关闭"""
+        with self._lock:
+            self._cancelled = True
+            stream = self.stream
+        if stream is not None:
+            stream.close()
+
+
+class _RoutedStream(ChatStream):
+    """经路由发出的流式回复：首 token 之前的对冲、超时与重试对调用方透明"""
+
+    def __init__(self, router, messages, route, temperature):
+        super().__init__()
+        self._router = router
+        self._messages = messages
+        self._route = route
+        self._temperature = temperature
+        self._stream = None
+        self._closed = False
+
+    def _pieces(self):
+        stream, pieces, first = self._router.open(self._messages, self._route, self._temperature)
+        self._stream = stream
+        if self._closed:
+            stream.close()
+            return
+        try:
+            yield first
+            yield from pieces
+        finally:
+            self.usage = stream.usage
+
+    def close(self):
+        self._closed = True
+        if self._stream is not None:
+            self._stream.close()
+
+
+class RoutedProvider(LLMProvider):
+    """在大模型后端外层按任务路由，负责对冲、超时、重试与熔断"""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self._breakers = {}
+        self._ttfts = defaultdict(lambda: deque(maxlen=_TTFT_HISTORY))  # (任务, 模型) -> 最近的首 token 延迟
+        self._lock = threading.Lock()
+        for task in (llm_provider.TASK_CHAT, llm_provider.TASK_REPORT_SECTION,
+                     llm_provider.TASK_SMART_REPLY, llm_provider.TASK_HEALTH_TIP):
+            route = route_for(task)
+            logger.info("route: task=%s tier=%s model=%s ttft_budget=%.1fs", task, route.tier, route.model, route.ttft_budget)
+
+    def stream(self, messages, *, task, model, temperature):
+        route = route_for(task)
+        if model != route.model:
+            # 调用方指定了别的模型时以调用方为准，时限仍按任务
+            route = Route(task, route.tier, model, route.ttft_budget)
+        return _RoutedStream(self, messages, route, temperature)
+
+    def breaker(self, model):
+        with self._lock:
+            breaker = self._breakers.get(model)
+            if breaker is None:
+                breaker = CircuitBreaker(model, config.BREAKER_FAILURES, config.BREAKER_COOLDOWN)
+                self._breakers[model] = breaker
+            return breaker
+
+    def open(self, messages, route, temperature):
+        """发出请求直到拿到首个片段，返回 (上游流, 片段迭代器, 首个片段)；重试用尽或熔断时抛出异常"""
+        breaker = self.breaker(route.model)
+        for attempt in range(config.LLM_RETRIES + 1):
+            if not breaker.allow():
+                metrics.metrics.record_route_event("circuit_open", route.task, route.model)
+                raise CircuitOpenError(f"circuit open for {route.model}")
+            try:
+                winner, first = self._race(messages, route, temperature)
+            except Exception as e:
+                opened = breaker.failure()
+                if opened:
+                    metrics.metrics.record_route_event("breaker_opened", route.task, route.model, error=type(e).__name__)
+                if attempt == config.LLM_RETRIES or opened:
+                    raise
+                delay = config.LLM_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+                logger.warning("retry: task=%s model=%s attempt=%d delay=%.2fs error=%s",
+                               route.task, route.model, attempt + 1, delay, e)
+                metrics.metrics.record_route_event("retry", route.task, route.model, attempt=attempt + 1,
+                                                   delay=delay, error=type(e).__name__)
+                time.sleep(delay)
+                # 重试沿用调用方的并发名额，但仍是一次新的上游请求，须计入速率
+                llm_client.limiter.take_token()
+                continue
+            breaker.success()
+            with self._lock:
+                self._ttfts[(route.task, route.model)].append(winner.ttft)
+            return winner.stream, winner.pieces, first
+
+    def hedge_delay(self, route):
+        """对冲请求的发出时间（秒）：近期首 token 延迟的分位数，不早于最短时间；不对冲时返回 None"""
+        if config.HEDGE_PERCENTILE <= 0:
+            return None
+        with self._lock:
+            samples = sorted(self._ttfts[(route.task, route.model)])
+        if len(samples) < config.HEDGE_MIN_SAMPLES:
+            delay = route.ttft_budget / 2
+        else:
+            index = min(len(samples) - 1, int(len(samples) * config.HEDGE_PERCENTILE / 100))
+            delay = samples[index]
+        delay = max(delay, config.HEDGE_MIN_DELAY)
+        return delay if delay < route.ttft_budget else None
+
+    def _race(self, messages, route, temperature):
+        results = queue.Queue()
+        attempts = [_Attempt(self.inner, messages, route, temperature)]
+        attempts[0].start(results)
+        started = time.monotonic()
+        deadline = started + route.ttft_budget
+        hedge_at = self.hedge_delay(route)
+        hedge_at = None if hedge_at is None else started + hedge_at
+        errors = 0
+        hedged = False
+        try:
+            while True:
+                wait_until = hedge_at if hedge_at is not None and len(attempts) == 1 else deadline
+                try:
+                    attempt, first, error = results.get(timeout=max(0.0, wait_until - time.monotonic()))
+                except queue.Empty:
+                    if time.monotonic() >= deadline:
+                        for attempt in attempts:
+                            attempt.cancel()
+                        metrics.metrics.record_route_event("timeout", route.task, route.model, budget=route.ttft_budget)
+                        raise FirstTokenTimeout(f"no first token from {route.model} within {route.ttft_budget:.1f}s")
+                    # 首 token 等待已超过近期的慢请求水平，再发一份相同请求；
+                    # 对冲请求另占一个上游名额，没有空闲名额或速率令牌时不对冲，继续等原请求
+                    if not llm_client.limiter.try_acquire():
+                        logger.info("hedge skipped: task=%s model=%s (upstream busy)", route.task, route.model)
+                        metrics.metrics.record_route_event("hedge_skipped", route.task, route.model, after=hedge_at - started)
+                        hedge_at = None
+                        continue
+                    hedged = True
+                    logger.info("hedge: task=%s model=%s after=%.2fs", route.task, route.model, hedge_at - started)
+                    metrics.metrics.record_route_event("hedge", route.task, route.model, after=hedge_at - started)
+                    hedge = _Attempt(self.inner, messages, route, temperature)
+                    attempts.append(hedge)
+                    hedge.start(results)
+                    continue
+                if error is not None:
+                    errors += 1
+                    # 还有请求在等首 token 时继续等；已发出的全部失败即算这一轮失败，交给重试
+                    if errors == len(attempts):
+                        raise error
+                    continue
+                for other in attempts:
+                    if other is not attempt:
+                        other.cancel()
+                if attempt is not attempts[0]:
+                    logger.info("hedge won: task=%s model=%s ttft=%.2fs", route.task, route.model, attempt.ttft)
+                    metrics.metrics.record_route_event("hedge_won", route.task, route.model, ttft=attempt.ttft)
+                return attempt, first
+        finally:
+            # 比赛结束后只剩一个请求继续输出，由调用方原有的名额承担；落败的请求已取消
+            if hedged:
+                llm_client.limiter.release()
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_provider(api_key=None):
+    """本进程共用的带路由的大模型后端；底层后端被替换（如压测注入本地桩）时随之重建"""
+    global _router
+    inner = llm_provider.get_provider(api_key)
+    with _router_lock:
+        if _router is None or _router.inner is not inner:
+            _router = RoutedProvider(inner)
+        return _router
@@ -0,0 +1,255 @@
+# ================= 性能指标 =================
+# 记录每次大模型调用（首 token 延迟、输出速度、总耗时、token 数、缓存命中）、
+# 模型路由的决策、照片上传处理和每次页面重跑的耗时：明细写入按大小轮转的 JSONL 日志，
+# 汇总值以 Prometheus 文本格式写入文件，并可选通过 HTTP 暴露。
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import RotatingFileHandler
+
+import config
+
+# 耗时直方图的分桶上限（秒）
+_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120)
+# 每个会话在调试面板中保留的最近记录数
+_SESSION_HISTORY = 50
+# Prometheus 文件的最短重写间隔（秒）
+_PROM_WRITE_INTERVAL = 1.0
+# 页面重跑的范围：整页 / 只重跑聊天区片段
+RERUN_APP = "app"
+RERUN_FRAGMENT = "fragment"
+
+
+@dataclass
+class CallRecord:
+    """一次大模型调用的指标"""
+    task: str
+    model: str
+    session_id: str
+    ttft: float = None
+    duration: float = None
+    prompt_tokens: int = None
+    completion_tokens: int = None
+    cache_hit: bool = False
+    error: str = None
+    ts: float = field(default_factory=time.time)
+
+    @property
+    def tokens_per_sec(self):
+        if not self.completion_tokens or not self.duration:
+            return None
+        generating = self.duration - (self.ttft or 0)
+        return self.completion_tokens / generating if generating > 0 else None
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * len(_BUCKETS)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += 1
+        self.sum += value
+
+
+class Metrics:
+    """进程内指标汇总"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)   # (名称, 标签) -> 值
+        self._histograms = defaultdict(_Histogram)
+        self._sessions = OrderedDict()  # session_id -> (最近记录, 最近写入时间)
+        self._last_prom_write = 0.0
+        self._logger = logging.getLogger("zhongyi.metrics")
+        self._logger.propagate = False
+        if config.METRICS_LOG_PATH and not self._logger.handlers:
+            _ensure_dir(config.METRICS_LOG_PATH)
+            handler = RotatingFileHandler(
+                config.METRICS_LOG_PATH, maxBytes=config.METRICS_LOG_MAX_BYTES,
+                backupCount=config.METRICS_LOG_BACKUPS, encoding="utf-8",
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(handler)
+            self._logger.setLevel(logging.INFO)
+
+    def record_call(self, record):
+        labels = (("task", record.task), ("model", record.model))
+        with self._lock:
+            self._counters[("zhongyi_llm_calls_total", labels + (("cache_hit", str(record.cache_hit).lower()),))] += 1
+            if record.error:
+                self._counters[("zhongyi_llm_errors_total", labels)] += 1
+            if record.prompt_tokens:
+                self._counters[("zhongyi_llm_prompt_tokens_total", labels)] += record.prompt_tokens
+            if record.completion_tokens:
+                self._counters[("zhongyi_llm_completion_tokens_total", labels)] += record.completion_tokens
+            if record.ttft is not None and not record.cache_hit:
+                self._histograms[("zhongyi_llm_ttft_seconds", labels)].observe(record.ttft)
+            if record.duration is not None:
+                self._histograms[("zhongyi_llm_duration_seconds", labels)].observe(record.duration)
+            self._session_append(record.session_id, ("call", record))
+        self._emit({"type": "llm_call", **asdict(record), "tokens_per_sec": record.tokens_per_sec})
+
+    def record_route_event(self, event, task, model, **detail):
+        """模型路由的一次决策（对冲、重试、超时、熔断、本地兜底）"""
+        labels = (("event", event), ("task", task), ("model", model))
+        with self._lock:
+            self._counters[("zhongyi_router_events_total", labels)] += 1
+        self._emit({"type": "router", "event": event, "task": task, "model": model, **detail, "ts": time.time()})
+
+    def record_image(self, session_id, result):
+        """一张上传照片的处理：原图与预处理后大小、预处理耗时、是否命中识别缓存"""
+        labels = (("kind", result.kind),)
+        with self._lock:
+            self._counters[("zhongyi_image_uploads_total", labels + (("cache_hit", str(result.cache_hit).lower()),))] += 1
+            self._counters[("zhongyi_image_upload_bytes_total", labels)] += result.upload_bytes
+            self._counters[("zhongyi_image_prepared_bytes_total", labels)] += result.prepared_bytes
+            self._histograms[("zhongyi_image_preprocess_seconds", labels)].observe(result.preprocess_seconds)
+        self._emit({
+            "type": "image", "session_id": session_id, "kind": result.kind, "cache_hit": result.cache_hit,
+            "upload_bytes": result.upload_bytes, "prepared_bytes": result.prepared_bytes,
+            "preprocess_seconds": result.preprocess_seconds, "analyze_seconds": result.analyze_seconds,
+            "ts": time.time(),
+        })
+
+    def record_rerun(self, session_id, duration, scope=RERUN_APP):
+        """一次页面重跑的耗时；scope 区分整页重跑与只重跑聊天区片段"""
+        with self._lock:
+            self._histograms[("zhongyi_rerun_seconds", (("scope", scope),))].observe(duration)
+            self._session_append(session_id, ("rerun", (scope, duration)))
+        self._emit({"type": "rerun", "session_id": session_id, "scope": scope, "duration": duration, "ts": time.time()})
+
+    def _session_append(self, session_id, item):
+        """追加一条会话记录；与会话存储一致，超出会话数上限或闲置过久的会话记录被淘汰（需持有锁）"""
+        now = time.monotonic()
+        entry = self._sessions.pop(session_id, None)
+        history = entry[0] if entry else deque(maxlen=_SESSION_HISTORY)
+        history.append(item)
+        self._sessions[session_id] = (history, now)
+        while self._sessions:
+            _, (_, last_used) = next(iter(self._sessions.items()))
+            if len(self._sessions) <= config.SESSION_MEMORY_ITEMS and now - last_used <= config.SESSION_IDLE_SECONDS:
+                break
+            self._sessions.popitem(last=False)
+
+    def session_snapshot(self, session_id):
+        """某会话最近的调用记录与页面重跑耗时 [(scope, 秒)]，供调试面板展示"""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            items = list(entry[0]) if entry else []
+        calls = [r for kind, r in items if kind == "call"]
+        reruns = [d for kind, d in items if kind == "rerun"]
+        return calls, reruns
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda kv: kv[0])
+            typed = set()
+            for (name, labels), value in counters:
+                if name not in typed:
+                    lines.append(f"# TYPE {name} counter")
+                    typed.add(name)
+                lines.append(f"{name}{_labels(labels)} {value:g}")
+            for (name, labels), hist in histograms:
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                for bound, count in zip(_BUCKETS, hist.counts):
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', f'{bound:g}'),))} {count}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {hist.total}")
+                lines.append(f"{name}_sum{_labels(labels)} {hist.sum:.6f}")
+                lines.append(f"{name}_count{_labels(labels)} {hist.total}")
+        return "\n".join(lines) + "\n"
+
+    def _emit(self, event):
+        self._logger.info(json.dumps(event, ensure_ascii=False, default=str))
+        now = time.monotonic()
+        if config.METRICS_PROM_PATH and now - self._last_prom_write >= _PROM_WRITE_INTERVAL:
+            self._last_prom_write = now
+            _ensure_dir(config.METRICS_PROM_PATH)
+            # 报告板块、模型路由等多个线程都会写指标，各用各的临时文件再替换
+            tmp = f"{config.METRICS_PROM_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(self.render_prometheus())
+            os.replace(tmp, config.METRICS_PROM_PATH)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def _ensure_dir(path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+
+def usage_tokens(usage):
+    """从接口返回的 usage（对象或字典）中取出 prompt / completion token 数"""
+    if usage is None:
+        return None, None
+    if isinstance(usage, dict):
+        return usage.get("prompt_tokens"), usage.get("completion_tokens")
+    return getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None)
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def track_call(task, model, session_id):
+    """计时一次大模型调用；调用方可在 with 块内补充 ttft、token 数等字段"""
+    record = CallRecord(task=task, model=model, session_id=session_id)
+    start = time.monotonic()
+    try:
+        yield record
+    except BaseException as e:
+        record.error = type(e).__name__
+        raise
+    finally:
+        record.duration = time.monotonic() - start
+        metrics.record_call(record)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_http_server(port=None):
+    """在后台线程启动 /metrics 服务（每个进程只启动一次）"""
+    global _server
+    port = config.METRICS_PORT if port is None else port
+    with _server_lock:
+        if _server is not None or not port:
+            return
+        _server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+        threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
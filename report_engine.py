@@ -0,0 +1,194 @@
+# ================= 分板块并行生成诊断报告 =================
+# 报告不再由一次长回复从头写到尾：先生成“深度辨证”，其余依赖辨证结论的板块并发请求，
+# “调理须知”直接套用本地模板；各板块按报告顺序输出，先写完的板块在队列里等候。
+# 经典、食疗、穴位板块附带本地知识库的检索结果；接口不可用时这几个板块改由本地资料拼出。
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import context
+import knowledge_base
+import llm_client
+import metrics
+from llm_provider import TASK_REPORT_SECTION, ChatStream
+from prompts import CMD_GENERATE_REPORT, REPORT_LOCAL_SECTIONS, REPORT_SECTIONS
+
+logger = logging.getLogger("zhongyi.report")
+
+# 单个板块生成失败且本地资料也无从补上时的占位文字，其余板块照常输出
+SECTION_FAILED = "（本板块暂未生成成功，您可以在下方继续追问。）"
+# 辨证都无法生成（接口不可用）时，报告改为本地资料整理
+OFFLINE_NOTE = "（当前网络繁忙，暂时无法完成个性化辨证。以下为根据您描述的症状从本地资料中整理的调养参考。）"
+
+# 本进程共用的板块生成线程池
+_executor = ThreadPoolExecutor(max_workers=config.REPORT_WORKERS, thread_name_prefix="report-section")
+_DONE = object()
+
+
+def section_messages(messages, title, guide, diagnosis="", references=""):
+    """单个板块的请求：沿用问诊上下文，把末尾的生成报告指令换成只写该板块的指令"""
+    instruction = f"请只输出诊断报告中的「{title}」板块，第一行为“{title}”，严格遵循以下要求，不要输出其他板块：\n{guide}"
+    if diagnosis:
+        instruction = f"以下是已经完成的辨证结论，请与之保持一致：\n{diagnosis}\n\n{instruction}"
+    if references:
+        instruction = f"{instruction}\n\n{references}"
+    base = messages[:-1] if messages[-1]["content"] == CMD_GENERATE_REPORT else messages
+    return base + [{"role": "user", "content": instruction}]
+
+
+def with_references(messages, query):
+    """整份报告一次生成时，把三类参考资料附在生成报告的指令后面"""
+    blocks = [knowledge_base.references(query, kind) for kind in knowledge_base.SECTION_KINDS.values()]
+    blocks = [block for block in blocks if block]
+    if not blocks:
+        return messages
+    last = messages[-1]
+    return messages[:-1] + [{"role": last["role"], "content": last["content"] + "\n\n" + "\n\n".join(blocks)}]
+
+
+def offline_report(query):
+    """接口不可用时完全由本地资料整理的报告"""
+    first_title = REPORT_SECTIONS[0][0]
+    parts = [f"{first_title}\n{OFFLINE_NOTE}\n"]
+    for title, guide in REPORT_SECTIONS[1:]:
+        text = f"{title}\n{guide}\n" if title in REPORT_LOCAL_SECTIONS else knowledge_base.offline_section(title, query)
+        if text:
+            parts.append(text)
+    return "\n".join(parts)
+
+
+class ReportStream(ChatStream):
+    """分板块并行生成的诊断报告，对外仍是一条按板块顺序输出的流"""
+
+    def __init__(self, provider, messages, *, session_id, model, temperature, on_wait=None, query=None):
+        super().__init__()
+        self._provider = provider
+        self._messages = messages
+        # 检索本地资料用的症状描述，默认取自消息中的用户回答
+        self._query = knowledge_base.symptom_query(messages) if query is None else query
+        self._session_id = session_id
+        self._model = model
+        self._temperature = temperature
+        self._on_wait = on_wait
+        self._lock = threading.Lock()
+        self._streams = []  # 进行中的上游流，close() 时一并关闭
+        self._closed = False
+        self._prompt_tokens = 0
+        self._completion_tokens = 0
+
+    def _pieces(self):
+        first_title, first_guide = REPORT_SECTIONS[0]
+        diagnosis = []
+        offline = False
+        try:
+            for piece in self._section(first_title, first_guide, on_wait=self._on_wait):
+                diagnosis.append(piece)
+                yield piece
+        except Exception as e:
+            if diagnosis:
+                raise
+            logger.warning("report diagnosis failed, falling back to local knowledge: %s", e)
+            metrics.metrics.record_route_event("fallback", TASK_REPORT_SECTION, self._model, error=type(e).__name__)
+            offline = True
+            diagnosis = [f"{first_title}\n{OFFLINE_NOTE}\n"]
+            yield diagnosis[0]
+        diagnosis = "".join(diagnosis)
+        last = diagnosis
+        # 辨证结论里的体质类型是检索其余板块资料的关键词
+        query = self._query if offline else f"{self._query} {diagnosis}"
+
+        # 其余板块同时发出，按报告顺序逐个取出
+        pending = []
+        for title, guide in REPORT_SECTIONS[1:]:
+            if title in REPORT_LOCAL_SECTIONS or offline or self._closed:
+                pending.append((title, guide, None))
+                continue
+            results = queue.Queue()
+            _executor.submit(self._fan_out, results, title, guide, diagnosis, query)
+            pending.append((title, guide, results))
+
+        for title, guide, results in pending:
+            if self._closed:
+                return
+            if results is None:
+                text = f"{title}\n{guide}\n" if title in REPORT_LOCAL_SECTIONS else knowledge_base.offline_section(title, query)
+                if text is None:
+                    continue
+                # 板块之间空一行
+                yield "\n" if last.endswith("\n") else "\n\n"
+                last = text
+                yield last
+                continue
+            yield "\n" if last.endswith("\n") else "\n\n"
+            started = False
+            while True:
+                item = results.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, Exception):
+                    # 已输出一半的板块不再整段替换，只补一句说明
+                    item = "\n" + SECTION_FAILED if started else (knowledge_base.offline_section(title, query) or SECTION_FAILED)
+                started = True
+                last = item
+                yield last
+        self.usage = {"prompt_tokens": self._prompt_tokens, "completion_tokens": self._completion_tokens}
+
+    def _fan_out(self, results, title, guide, diagnosis, query):
+        if self._closed:
+            results.put(_DONE)
+            return
+        kind = knowledge_base.SECTION_KINDS.get(title)
+        references = knowledge_base.references(query, kind) if kind else ""
+        try:
+            for piece in self._section(title, guide, diagnosis, references):
+                results.put(piece)
+        except Exception as e:
+            logger.warning("report section %s failed: %s", title, e)
+            results.put(e)
+        finally:
+            results.put(_DONE)
+
+    def _section(self, title, guide, diagnosis="", references="", on_wait=None):
+        payload = section_messages(self._messages, title, guide, diagnosis, references)
+        text = []
+        with llm_client.limiter.slot(self._session_id, on_wait=on_wait):
+            # 排队期间报告可能已被关闭，此时不再发起请求
+            if self._closed:
+                return
+            with metrics.track_call(TASK_REPORT_SECTION, self._model, self._session_id) as record:
+                stream = self._provider.stream(
+                    payload, task=TASK_REPORT_SECTION, model=self._model, temperature=self._temperature
+                )
+                with self._lock:
+                    self._streams.append(stream)
+                    # close() 可能恰好发生在打开上游之后、登记之前
+                    closed = self._closed
+                if closed:
+                    stream.close()
+                try:
+                    for piece in stream:
+                        if self._closed:
+                            break
+                        text.append(piece)
+                        yield piece
+                finally:
+                    with self._lock:
+                        self._streams.remove(stream)
+                record.ttft = stream.ttft
+                record.prompt_tokens, record.completion_tokens = metrics.usage_tokens(stream.usage)
+                if record.prompt_tokens is None:
+                    record.prompt_tokens = context.count_messages_tokens(payload)
+                if record.completion_tokens is None:
+                    record.completion_tokens = context.count_tokens("".join(text))
+        with self._lock:
+            self._prompt_tokens += record.prompt_tokens
+            self._completion_tokens += record.completion_tokens
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            streams = list(self._streams)
+        for stream in streams:
+            stream.close()
@@ -0,0 +1,118 @@
+# ================= 回复缓存 =================
+# 首页快捷入口、报告后的追问按钮发送的都是固定文本，相同的对话无需重复生成。
+# 以“提示词版本 + 规范化对话 + 模型 + 温度”的哈希为键，
+# 内存 LRU 在前，SQLite 磁盘缓存在后（按总字节数淘汰最久未用的条目）。
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import config
+from prompts import SYSTEM_PROMPT_VERSION
+
+_SPACE_RE = re.compile(r"\s+")
+# 回放缓存时每次输出的字数
+_REPLAY_CHUNK = 24
+
+
+def normalize(text):
+    """全角转半角、合并空白，使写法略有差异的相同内容得到同一个键"""
+    return _SPACE_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def make_key(messages, model, temperature):
+    """对话的规范化哈希；系统提示词以版本号代替全文"""
+    turns = [(m["role"], normalize(m["content"])) for m in messages if m["role"] != "system"]
+    payload = json.dumps(
+        {"prompt": SYSTEM_PROMPT_VERSION, "model": model, "temperature": temperature, "turns": turns},
+        ensure_ascii=False, separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def replay(text):
+    """把缓存的完整回复切成小段，交给流式渲染器按原流程展示"""
+    for i in range(0, len(text), _REPLAY_CHUNK):
+        yield text[i:i + _REPLAY_CHUNK]
+
+
+class ResponseCache:
+    """两级回复缓存：内存 LRU + SQLite"""
+
+    def __init__(self, path, memory_items, max_bytes):
+        self._memory = OrderedDict()
+        self._memory_items = memory_items
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_responses_access ON responses(last_access)")
+        self._db.commit()
+
+    def get(self, key):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                return value
+            row = self._db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self._remember(key, row[0])
+            return row[0]
+
+    def put(self, key, value):
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._remember(key, value)
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._evict()
+            self._db.commit()
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._memory_items:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self._max_bytes:
+            return
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+        for key, size in rows:
+            if total <= self._max_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._memory.pop(key, None)
+            total -= size
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """本进程共用的回复缓存"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(config.CACHE_DB_PATH, config.CACHE_MEMORY_ITEMS, config.CACHE_MAX_BYTES)
+        return _cache
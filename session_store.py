@@ -0,0 +1,226 @@
+# ================= 问诊会话存储 =================
+# 问诊状态不再只放在 st.session_state 里：每次变化都以事件形式追加写入 SQLite（WAL 模式），
+# 网址带上 ?sid= 即可在重启或切换副本后继续同一次问诊。
+# 内存中只保留最近活跃的会话，闲置的换出到磁盘；系统提示词按版本只存一份。
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import config
+from prompts import CMD_GENERATE_REPORT, MAX_TURNS, SYSTEM_PROMPT, SYSTEM_PROMPT_VERSION, initial_messages
+
+logger = logging.getLogger("zhongyi.sessions")
+
+# 事件类型：一条消息，或一次阶段/轮次/选项的变化
+EVENT_MESSAGE = "message"
+EVENT_STATE = "state"
+# 会话锁的数量：按会话编号分片，锁的总数固定，不随会话增多
+_SESSION_LOCKS = 64
+
+
+class Consultation:
+    """一次问诊的全部状态：消息、阶段、轮次、回答选项"""
+
+    def __init__(self, session_id, messages, stage=0, turn_count=0, suggested_options=None):
+        self.session_id = session_id
+        self.messages = messages
+        self.stage = stage
+        self.turn_count = turn_count
+        self.suggested_options = list(suggested_options or [])
+        # 已落盘的消息条数、状态及事件序号，用于增量写入
+        self._saved_messages = len(messages)
+        self._saved_state = self._state()
+        self._seq = 0
+
+    def add_user_input(self, text):
+        """记录用户回答，推进阶段与轮次；达到最大轮次时追加生成报告的隐藏指令"""
+        self.messages.append({"role": "user", "content": text})
+        if self.stage == 0:
+            self.stage = 1
+        if self.stage == 1:
+            self.turn_count += 1
+            # 只有在达到绝对最大上限时才强制触发，否则交给 AI 或用户按钮决定
+            if self.turn_count >= MAX_TURNS:
+                self.messages.append({"role": "user", "content": CMD_GENERATE_REPORT})
+
+    def wants_report(self):
+        """本轮是否应生成诊断报告（达到轮次上限或用户主动结束）；报告之后的追问不算"""
+        if self.stage == 2:
+            return False
+        return self.turn_count >= MAX_TURNS or CMD_GENERATE_REPORT in self.messages[-1]["content"]
+
+    def add_reply(self, text, report=False):
+        """记录 AI 回复；是报告时进入结果页"""
+        self.messages.append({"role": "assistant", "content": text})
+        if report:
+            self.stage = 2
+            self.suggested_options = []
+
+    @property
+    def dirty(self):
+        return len(self.messages) > self._saved_messages or self._state() != self._saved_state
+
+    def _state(self):
+        return (self.stage, self.turn_count, tuple(self.suggested_options))
+
+
+class SessionStore:
+    """追加写入的 SQLite 会话存储，内存中按最近活跃保留一部分会话"""
+
+    def __init__(self, path, memory_items, idle_seconds):
+        self._live = OrderedDict()  # session_id -> (Consultation, 最近访问时间)
+        self._memory_items = memory_items
+        self._idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._session_locks = [threading.RLock() for _ in range(_SESSION_LOCKS)]
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS prompts (version TEXT PRIMARY KEY, content TEXT NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " session_id TEXT PRIMARY KEY, prompt_version TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " session_id TEXT NOT NULL, seq INTEGER NOT NULL, kind TEXT NOT NULL,"
+            " role TEXT, content TEXT NOT NULL, ts REAL NOT NULL,"
+            " PRIMARY KEY (session_id, seq))"
+        )
+        self._db.execute(
+            "INSERT OR IGNORE INTO prompts (version, content) VALUES (?, ?)",
+            (SYSTEM_PROMPT_VERSION, SYSTEM_PROMPT),
+        )
+        self._db.commit()
+
+    def create(self):
+        """新建一次问诊并立即落盘"""
+        consult = Consultation(uuid.uuid4().hex, initial_messages())
+        # 系统提示词不随会话保存，只记录版本号
+        consult._saved_messages = 1
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO sessions (session_id, prompt_version, created) VALUES (?, ?, ?)",
+                (consult.session_id, SYSTEM_PROMPT_VERSION, time.time()),
+            )
+            self._append(consult)
+            self._remember(consult)
+        return consult
+
+    def get(self, session_id):
+        """取出会话；不在内存或已被其他副本更新时从磁盘重建，不存在时返回 None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MAX(seq) FROM events WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row[0] is None:
+                return None
+            entry = self._live.get(session_id)
+            consult = entry[0] if entry else None
+            if consult is None or consult._seq != row[0]:
+                consult = self._load(session_id)
+            if consult is not None:
+                self._remember(consult)
+            return consult
+
+    def lock(self, session_id):
+        """同一会话“取出 - 检查 - 修改 - 保存”需在此锁内完成，页面回调与后台写回才不会交错（可重入）"""
+        return self._session_locks[hash(session_id) % len(self._session_locks)]
+
+    def save(self, consult):
+        """把会话自上次保存以来的变化追加写入磁盘"""
+        with self._lock:
+            if consult.dirty:
+                self._append(consult)
+
+    def _append(self, consult):
+        now = time.time()
+        rows = []
+        seq = consult._seq
+        for message in consult.messages[consult._saved_messages:]:
+            seq += 1
+            rows.append((consult.session_id, seq, EVENT_MESSAGE, message["role"], message["content"], now))
+        state = consult._state()
+        if state != consult._saved_state:
+            seq += 1
+            payload = json.dumps(
+                {"stage": state[0], "turn_count": state[1], "suggested_options": list(state[2])},
+                ensure_ascii=False,
+            )
+            rows.append((consult.session_id, seq, EVENT_STATE, None, payload, now))
+        if not rows:
+            return
+        try:
+            self._db.executemany(
+                "INSERT INTO events (session_id, seq, kind, role, content, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._db.commit()
+        except sqlite3.IntegrityError:
+            # 同一会话已在其他副本写入了更新的事件，以磁盘为准
+            self._db.rollback()
+            logger.warning("session %s was updated elsewhere, dropping local changes", consult.session_id)
+            return
+        consult._seq = seq
+        consult._saved_messages = len(consult.messages)
+        consult._saved_state = state
+
+    def _load(self, session_id):
+        row = self._db.execute(
+            "SELECT p.content FROM sessions s LEFT JOIN prompts p ON p.version = s.prompt_version"
+            " WHERE s.session_id = ?",
+            (session_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        messages = [{"role": "system", "content": row[0] or SYSTEM_PROMPT}]
+        stage, turn_count, options, seq = 0, 0, [], 0
+        for seq, kind, role, content in self._db.execute(
+            "SELECT seq, kind, role, content FROM events WHERE session_id = ? ORDER BY seq", (session_id,)
+        ):
+            if kind == EVENT_MESSAGE:
+                messages.append({"role": role, "content": content})
+            else:
+                state = json.loads(content)
+                stage, turn_count, options = state["stage"], state["turn_count"], state["suggested_options"]
+        consult = Consultation(session_id, messages, stage, turn_count, options)
+        consult._seq = seq
+        return consult
+
+    def _remember(self, consult):
+        now = time.monotonic()
+        self._live[consult.session_id] = (consult, now)
+        self._live.move_to_end(consult.session_id)
+        # 换出超出容量或闲置过久的会话，换出前把未保存的变化写入磁盘
+        while self._live:
+            session_id, (oldest, last_used) = next(iter(self._live.items()))
+            if len(self._live) <= self._memory_items and now - last_used <= self._idle_seconds:
+                break
+            if oldest.dirty:
+                self._append(oldest)
+            del self._live[session_id]
+
+    def live_count(self):
+        with self._lock:
+            return len(self._live)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """本进程共用的会话存储"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SessionStore(config.SESSION_DB_PATH, config.SESSION_MEMORY_ITEMS, config.SESSION_IDLE_SECONDS)
+        return _store
@@ -0,0 +1,82 @@
+# ================= 智能回复选项 =================
+# 先用本地规则解析“是否…”“A还是B”“有没有A或者B”这类常见问法，
+# 解析不了的疑难问句才交给后台线程调用大模型，不阻塞问诊主流程。
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+# 选项最长字数，与大模型提示词中的“答案不要超过6个字”保持一致
+MAX_OPTION_LEN = 6
+
+YES_NO_OPTIONS = ["是", "否", "不清楚"]
+HAVE_OPTIONS = ["有", "没有", "不清楚"]
+
+# 句子分隔符：问句以全角/半角问号结尾
+_SENTENCE_RE = re.compile(r"[^。！!？?\n]*[？?]")
+# 选择题中的连接词
+_CHOICE_SPLIT_RE = re.compile(r"还是|或者|或是|、")
+# 选项前常见的铺垫词，取最后一个之后的内容作为第一个选项；
+# “偏”“容易”等属于选项本身（偏白/偏黄、容易上火/容易怕冷），不在此列，否则只有第一个选项被截掉
+_LEAD_RE = re.compile(r".*(?:您|是否|有没有|有无|是不是|是|会|比较|更|觉得|感觉|以|多|在|，|,)")
+# 各选项开头的介词，所有选项一样去掉（“在白天还是在晚上” -> 白天|晚上）
+_PREP_RE = re.compile(r"^(?:在|于)")
+# 开放式问法，是/否无法回答
+_OPEN_RE = re.compile(r"描述|说说|讲讲|怎么|怎样|什么|哪|多久|多少|几")
+# 选项后常见的收尾词
+_TAIL_RE = re.compile(r"(?:的情况|的感觉|的症状|的现象|的时候|多一些|比较多|更多|一些|呢|吗|呀|啊)+$")
+
+# 本进程共用的后台线程池，只处理本地规则覆盖不了的问句
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="smart-reply")
+
+
+def extract_question(text):
+    """取出文本中最后一个完整的问句，没有问句时返回空字符串"""
+    sentences = _SENTENCE_RE.findall(text or "")
+    return sentences[-1].strip() if sentences else ""
+
+
+def _clean_option(part, strip_lead):
+    part = part.strip(" ？?。，,“”\"'")
+    if strip_lead:
+        part = _LEAD_RE.sub("", part)
+    part = _PREP_RE.sub("", part)
+    part = _TAIL_RE.sub("", part).strip(" ？?。，,“”\"'")
+    return part
+
+
+def _parse_choices(question):
+    parts = _CHOICE_SPLIT_RE.split(question.rstrip("？?"))
+    if len(parts) < 2:
+        return None
+    options = [_clean_option(parts[0], True)]
+    options += [_clean_option(p, False) for p in parts[1:]]
+    # 末尾选项可能带着“多一些呢”之类的尾巴，已在 _clean_option 中去掉
+    if any(not o or len(o) > MAX_OPTION_LEN for o in options):
+        return None
+    if len(set(options)) != len(options):
+        return None
+    if len(options) == 2:
+        # 例：“睡不着还是盗汗？” -> 睡不着|盗汗|都有|都没有
+        return options + ["都有", "都没有"]
+    return options[:3] + ["都不是"]
+
+
+def quick_replies(question):
+    """本地规则生成回复选项；规则无法覆盖时返回 None，交由大模型处理"""
+    if not question:
+        return None
+    if "还是" in question or "或者" in question or "或是" in question:
+        return _parse_choices(question)
+    if _OPEN_RE.search(question):
+        return None
+    if "是否" in question or "是不是" in question:
+        return list(YES_NO_OPTIONS)
+    if "有没有" in question or "有无" in question:
+        return list(HAVE_OPTIONS)
+    if question.rstrip("？?").endswith("吗"):
+        return list(YES_NO_OPTIONS)
+    return None
+
+
+def submit(question, generate):
+    """后台生成回复选项，返回 Future；generate 为调用大模型的兜底函数"""
+    return _executor.submit(generate, question)
@@ -0,0 +1,37 @@
+# ================= 流式阶段识别 =================
+# 不必等整段回复结束：逐个分片增量判断 AI 是提出了问题，还是已开始输出诊断报告，
+# 以便提前准备回答选项，或立即切到报告阶段、不再为报告准备无用的回答选项。
+import smart_reply
+from prompts import REPORT_MARKERS
+
+# 报告标题可能被拆在相邻分片中，保留这么多字符与下一分片拼接后再查找
+_TAIL_LEN = max(len(marker) for marker in REPORT_MARKERS) - 1
+
+EVENT_QUESTION = "question"
+EVENT_REPORT = "report"
+
+
+class StageDetector:
+    """增量识别流式回复：出现完整问句 / 开始输出诊断报告"""
+
+    def __init__(self):
+        self.question = ""
+        self.report = False
+        self._chunks = []
+        self._tail = ""
+
+    def feed(self, text):
+        """送入一个分片，返回本分片触发的事件（EVENT_QUESTION / EVENT_REPORT），没有则返回 None"""
+        if self.report or not text:
+            return None
+        self._chunks.append(text)
+        window = self._tail + text
+        if any(marker in window for marker in REPORT_MARKERS):
+            self.report = True
+            return EVENT_REPORT
+        self._tail = window[-_TAIL_LEN:]
+        if not self.question and ("？" in text or "?" in text):
+            self.question = smart_reply.extract_question("".join(self._chunks))
+            if self.question:
+                return EVENT_QUESTION
+        return None
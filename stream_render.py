@@ -0,0 +1,66 @@
+# ================= 流式渲染 =================
+# 大模型逐字输出时，按时间/字节合并刷新，且只重绘正在书写的板块：
+# 已写完的 “### ” 板块冻结为独立元素，不再随每个分片重新发送。
+import re
+import time
+
+import streamlit as st
+
+import config
+
+# 新板块标题出现的位置（行首的 “### ”）
+_SECTION_RE = re.compile(r"\n(?=### )")
+
+
+def split_sections(text):
+    """拆成已写完的板块和正在书写的板块：最后一个 “### ” 标题之前的内容都已写完"""
+    active = _SECTION_RE.split(text)[-1]
+    return text[:len(text) - len(active)], active
+
+
+class StreamRenderer:
+    """合并刷新的流式 Markdown 渲染器"""
+
+    def __init__(self, flush_interval=None, flush_bytes=None, cursor=" ▌"):
+        self._flush_interval = config.STREAM_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self._flush_bytes = config.STREAM_FLUSH_BYTES if flush_bytes is None else flush_bytes
+        self._cursor = cursor
+        self._frozen = []   # 已完成的板块
+        self._chunks = []   # 正在书写的板块，按分片累积
+        self._pending = 0   # 上次刷新后新增的字节数
+        self._last_flush = 0.0
+        # 流式过程中用多个元素展示，结束后整体替换为一个元素，与历史消息渲染一致
+        self._outer = st.empty()
+        self._box = self._outer.container()
+        self._active = self._box.empty()
+
+    def write(self, text):
+        if not text:
+            return
+        self._chunks.append(text)
+        self._pending += len(text.encode("utf-8"))
+        now = time.monotonic()
+        if self._pending >= self._flush_bytes or now - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        active = "".join(self._chunks)
+        # 出现新的板块标题，说明之前的板块已写完，冻结后不再重绘
+        parts = _SECTION_RE.split(active)
+        for done in parts[:-1]:
+            self._active.markdown(done)
+            self._frozen.append(done + "\n")
+            self._active = self._box.empty()
+        self._chunks = [parts[-1]]
+        self._active.markdown(parts[-1] + self._cursor)
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def getvalue(self):
+        return "".join(self._frozen) + "".join(self._chunks)
+
+    def close(self):
+        """输出结束：去掉光标，整段替换为一个 Markdown 元素，返回完整文本"""
+        text = self.getvalue()
+        self._outer.markdown(text)
+        return text
@@ -0,0 +1,100 @@
+# ================= 养生锦囊缓存池 =================
+# 全进程共用一个按主题分桶的锦囊池，由后台线程补货，
+# 用户点击“获取新知识”时直接从池中取，不再同步等待大模型。
+# 只在创建时和有人取用后发现不足时补货，没有人使用时不调用接口。
+import random
+import re
+import threading
+import time
+
+# 去重时忽略 emoji、标点和空白，只比较正文
+_NORMALIZE_RE = re.compile(r"[^一-鿿A-Za-z0-9]")
+
+
+def _normalize(text):
+    return _NORMALIZE_RE.sub("", text)
+
+
+class TipPool:
+    """按主题分桶的锦囊池：TTL 过期 + 去重，取用时发现不足再由后台线程补货"""
+
+    def __init__(self, generate, themes, fallback, target=3, ttl=1800, refill_interval=2.0):
+        # generate(theme) 返回一条锦囊文本，失败时抛异常
+        self._generate = generate
+        self._themes = list(themes)
+        self._fallback = list(fallback)
+        self._target = target
+        self._ttl = ttl
+        self._refill_interval = refill_interval
+        # 每个主题一个字典：文本 -> 生成时间，每桶最多 target 条
+        self._buckets = {theme: {} for theme in self._themes}
+        self._seen = {}  # 归一化文本 -> 原文本，用于跨主题去重
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._refill_loop, name="tip-pool-refill", daemon=True)
+        self._thread.start()
+
+    def take(self, exclude=None):
+        """随机取一条锦囊（尽量避开 exclude），池子为空时退回本地备用锦囊"""
+        with self._lock:
+            self._purge_expired()
+            candidates = [
+                (theme, tip)
+                for theme, bucket in self._buckets.items()
+                for tip in bucket
+                if tip != exclude
+            ]
+            tip = random.choice(candidates)[1] if candidates else None
+            low = any(len(bucket) < self._target for bucket in self._buckets.values())
+        if low:
+            self._wakeup.set()
+        if tip is None:
+            choices = [t for t in self._fallback if t != exclude] or self._fallback
+            tip = random.choice(choices)
+        return tip
+
+    def add(self, theme, tip):
+        """放入一条锦囊；重复内容返回 False"""
+        tip = (tip or "").strip()
+        key = _normalize(tip)
+        if not key:
+            return False
+        with self._lock:
+            if key in self._seen or theme not in self._buckets:
+                return False
+            self._buckets[theme][tip] = time.monotonic()
+            self._seen[key] = tip
+        return True
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        for bucket in self._buckets.values():
+            for tip, created in list(bucket.items()):
+                if now - created > self._ttl:
+                    del bucket[tip]
+                    self._seen.pop(_normalize(tip), None)
+
+    def _next_theme(self):
+        with self._lock:
+            self._purge_expired()
+            hungry = [(len(b), t) for t, b in self._buckets.items() if len(b) < self._target]
+        if not hungry:
+            return None
+        # 优先补最空的桶
+        return min(hungry)[1]
+
+    def _refill_loop(self):
+        while True:
+            theme = self._next_theme()
+            if theme is None:
+                # 各桶都已补满：等到有人取用时发现不足再补，期间不调用接口
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                added = self.add(theme, self._generate(theme))
+            except Exception:
+                added = False
+            if not added:
+                # 接口异常或生成重复内容时稍后重试，期间由备用锦囊兜底
+                time.sleep(self._refill_interval)
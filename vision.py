@@ -0,0 +1,152 @@
+# ================= 照片识别后端 =================
+# 舌诊、面诊、拍报告、拍药盒四类照片统一经由 VisionBackend 识别，
+# 可在智谱视觉模型与本地桩之间切换，无 Key 时也能离线压测上传链路。
+# 识别结果是按固定字段整理的简短文字，写入问诊对话时只占几十个 token。
+import base64
+import hashlib
+import re
+import threading
+import time
+
+import config
+import llm_client
+
+KIND_TONGUE = "tongue"
+KIND_FACE = "face"
+KIND_LAB_REPORT = "lab_report"
+KIND_MEDICINE = "medicine"
+
+# 照片类型 -> (写入对话时的标题, 需要识别的字段)
+KINDS = {
+    KIND_TONGUE: ("舌象照片", ("舌色", "舌苔", "舌形", "津液")),
+    KIND_FACE: ("面色照片", ("面色", "光泽", "唇色", "眼神")),
+    KIND_LAB_REPORT: ("检查报告照片", ("报告类型", "异常项目", "报告结论")),
+    KIND_MEDICINE: ("药盒照片", ("药品名称", "主要成分", "功效", "用法用量", "禁忌")),
+}
+
+_PROMPTS = {
+    KIND_TONGUE: "这是一张舌头的照片，请按中医舌诊观察。",
+    KIND_FACE: "这是一张面部照片，请按中医望诊观察面色与神态。",
+    KIND_LAB_REPORT: "这是一张体检或化验报告的照片，请摘录要点，异常项目只列名称和偏高/偏低。",
+    KIND_MEDICINE: "这是一张药盒或说明书的照片，请摘录药品信息。",
+}
+
+# 识别结果中“字段：内容”的一行
+_FIELD_RE = re.compile(r"^\s*[-*]?\s*([^：:]{1,8})[：:]\s*(.+?)\s*$")
+# 每个字段保留的最长字数
+_MAX_VALUE_LEN = 40
+
+
+def build_prompt(kind):
+    """识别提示词：要求逐行输出固定字段，看不清的写“不清楚”"""
+    fields = KINDS[kind][1]
+    lines = "\n".join(f"{name}：" for name in fields)
+    return (
+        f"{_PROMPTS[kind]}只输出以下{len(fields)}行，每行不超过20字，看不清的写“不清楚”，不要输出其他内容：\n{lines}"
+    )
+
+
+def parse_findings(kind, text):
+    """从识别回复中取出各字段，缺少的字段记为“不清楚”"""
+    found = {}
+    for line in (text or "").splitlines():
+        match = _FIELD_RE.match(line)
+        if match and match.group(1).strip() in KINDS[kind][1]:
+            found[match.group(1).strip()] = match.group(2)[:_MAX_VALUE_LEN]
+    return {name: found.get(name, "不清楚") for name in KINDS[kind][1]}
+
+
+def format_findings(kind, findings):
+    """写入问诊对话的紧凑文字，如“【舌象照片】舌色：淡红；舌苔：薄白；…”"""
+    title = KINDS[kind][0]
+    return f"【{title}】" + "；".join(f"{name}：{value}" for name, value in findings.items())
+
+
+class VisionBackend:
+    """照片识别后端接口"""
+
+    model = None
+
+    def analyze(self, kind, image):
+        """识别一张已预处理的 JPEG 照片，返回 {字段: 内容}"""
+        raise NotImplementedError
+
+
+class ZhipuVisionBackend(VisionBackend):
+    """智谱视觉模型"""
+
+    def __init__(self, api_key, model):
+        self._client = llm_client.get_client(api_key)
+        self.model = model
+
+    def analyze(self, kind, image):
+        response = self._client.chat.completions.create(
+            model=self.model,
+            temperature=0.1,
+            messages=[{
+                "role": "user",
+                "content": [
+                    {"type": "image_url", "image_url": {"url": base64.b64encode(image).decode("ascii")}},
+                    {"type": "text", "text": build_prompt(kind)},
+                ],
+            }],
+        )
+        return parse_findings(kind, response.choices[0].message.content)
+
+
+# 本地桩的候选识别结果，按照片内容的哈希挑选，同一张照片结果固定
+STUB_FINDINGS = {
+    "舌色": ["淡红", "淡白", "偏红", "暗紫"],
+    "舌苔": ["薄白", "白腻", "黄腻", "少苔"],
+    "舌形": ["适中", "胖大、边有齿痕", "瘦薄", "有裂纹"],
+    "津液": ["润", "偏干", "水滑"],
+    "面色": ["红润", "萎黄", "㿠白", "晦暗"],
+    "光泽": ["有光泽", "少光泽"],
+    "唇色": ["淡红", "淡白", "偏暗"],
+    "眼神": ["有神", "略显疲倦"],
+    "报告类型": ["血常规", "肝功能", "血脂四项"],
+    "异常项目": ["无", "血红蛋白偏低", "甘油三酯偏高"],
+    "报告结论": ["未见明显异常", "建议复查"],
+    "药品名称": ["六味地黄丸", "逍遥丸", "归脾丸"],
+    "主要成分": ["熟地黄、山茱萸、山药等", "柴胡、当归、白芍等", "党参、白术、黄芪等"],
+    "功效": ["滋阴补肾", "疏肝健脾", "益气健脾、养血安神"],
+    "用法用量": ["口服，一次8丸，一日3次"],
+    "禁忌": ["忌辛辣、生冷、油腻食物"],
+}
+
+
+class StubVisionBackend(VisionBackend):
+    """本地桩：按设定的延迟返回由照片内容决定的固定结果"""
+
+    model = "vision-stub"
+
+    def __init__(self, latency=None):
+        self.latency = config.VISION_STUB_LATENCY if latency is None else latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def analyze(self, kind, image):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        digest = hashlib.sha256(image).digest()
+        return {
+            name: STUB_FINDINGS[name][digest[i] % len(STUB_FINDINGS[name])]
+            for i, name in enumerate(KINDS[kind][1])
+        }
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend(api_key=None):
+    """本进程共用的照片识别后端，由 ZY_VISION_PROVIDER 选择（默认与大模型后端一致）"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if config.VISION_PROVIDER == "stub":
+                _backend = StubVisionBackend()
+            else:
+                _backend = ZhipuVisionBackend(api_key, config.VISION_MODEL)
+        return _backend